@@ -1,14 +1,36 @@
+import hmac
 import os
 import pdb
-from flask import Flask, render_template, request, flash, redirect, session, g, url_for
+import click
+from flask import Flask, render_template, request, flash, redirect, session, g, url_for, jsonify, abort
+from flask import Response, stream_with_context, get_template_attribute
 from flask_debugtoolbar import DebugToolbarExtension
+from werkzeug.local import LocalProxy
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.exc import ObjectDeletedError
 
+import migrations
+from assets import assets
+from explain import check_query_plans
+from fragments import FragmentCache
 from forms import UserAddForm, UserEditForm, LoginForm, MessageForm
-from models import db, connect_db, User, Message
+from httpcache import conditional, make_etag, source_version
+from metrics import request_metrics
+from pagecache import page_cache
+from models import db, connect_db, User, Message, Likes, Follows, TimelineEntry
+from pagination import decode_cursor, keyset_page
+from passwords import password_hasher
+from routing import pool_stats
+from search import username_index
+from throttle import client_ip, login_throttle
+from user_cache import UserCache
 from functools import wraps
 
 CURR_USER_KEY = "curr_user"
+MESSAGES_PER_PAGE = 25
+USERS_PER_PAGE = 24
+MAX_BULK_FOLLOWS = 100
 
 app = Flask(__name__)
 
@@ -18,12 +40,232 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# Connection pool per engine and worker (see routing): keep
+# workers * (DATABASE_POOL_SIZE + DATABASE_MAX_OVERFLOW) under the server's
+# max_connections
+app.config['DATABASE_POOL_SIZE'] = int(os.environ.get('DATABASE_POOL_SIZE', 5))
+app.config['DATABASE_MAX_OVERFLOW'] = int(
+    os.environ.get('DATABASE_MAX_OVERFLOW', 10))
+app.config['DATABASE_POOL_TIMEOUT'] = float(
+    os.environ.get('DATABASE_POOL_TIMEOUT', 30))
+app.config['DATABASE_POOL_RECYCLE'] = int(
+    os.environ.get('DATABASE_POOL_RECYCLE', 1800))
+app.config['DATABASE_POOL_PRE_PING'] = (
+    os.environ.get('DATABASE_POOL_PRE_PING', '1') == '1')
+
+# Read replicas for the read-only routes, comma separated; a client reads
+# from the primary for DATABASE_PRIMARY_AFTER_WRITE seconds after writing
+app.config['DATABASE_REPLICA_URLS'] = [
+    url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+    if url]
+app.config['DATABASE_REPLICA_ENDPOINTS'] = ['homepage', 'users_show',
+                                            'list_users', 'messages_show']
+app.config['DATABASE_PRIMARY_AFTER_WRITE'] = float(
+    os.environ.get('DATABASE_PRIMARY_AFTER_WRITE', 5))
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Stream the /users directory to the client as cards are rendered, rather
+# than building the whole page in memory first.
+app.config['STREAM_USER_DIRECTORY'] = (
+    os.environ.get('STREAM_USER_DIRECTORY') == '1')
+
+# Logged-in users are cached per process for a few seconds (see user_cache)
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 1024))
+app.config['USER_CACHE_TTL'] = float(os.environ.get('USER_CACHE_TTL', 30))
+
+# bcrypt work factor, and the process pool hashing runs on (see passwords);
+# 0 workers hashes inline on the request thread. The pool is per web worker,
+# so under gunicorn -w N there are N * BCRYPT_POOL_WORKERS hashing processes:
+# keep that product around the number of CPUs.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['BCRYPT_POOL_WORKERS'] = int(
+    os.environ.get('BCRYPT_POOL_WORKERS', 1))
+app.config['BCRYPT_POOL_MAX_PENDING'] = int(
+    os.environ.get('BCRYPT_POOL_MAX_PENDING', 64))
+
+# Login attempts allowed per username and per client IP before we stop
+# checking passwords (see throttle). 'memory' buckets are per process;
+# 'database' buckets are shared by every worker.
+app.config['LOGIN_THROTTLE_BACKEND'] = os.environ.get(
+    'LOGIN_THROTTLE_BACKEND', 'memory')
+app.config['LOGIN_THROTTLE_USERNAME_BURST'] = 5
+app.config['LOGIN_THROTTLE_USERNAME_PER_MINUTE'] = 5
+app.config['LOGIN_THROTTLE_IP_BURST'] = 20
+app.config['LOGIN_THROTTLE_IP_PER_MINUTE'] = 20
+# number of reverse proxies in front of the app setting X-Forwarded-For
+app.config['LOGIN_THROTTLE_PROXY_COUNT'] = int(
+    os.environ.get('LOGIN_THROTTLE_PROXY_COUNT', 0))
+
+# Rendered message list items kept per process (see fragments)
+app.config['MESSAGE_FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('MESSAGE_FRAGMENT_CACHE_SIZE', 10000))
+
+# Cache whole pages for visitors who aren't logged in (see pagecache):
+# fresh for PAGE_CACHE_TTL seconds, then served for up to PAGE_CACHE_STALE
+# more while re-rendered in the background. 'memory' pages are per process;
+# 'database' pages are shared by every worker.
+app.config['PAGE_CACHE'] = os.environ.get('PAGE_CACHE') == '1'
+app.config['PAGE_CACHE_BACKEND'] = os.environ.get(
+    'PAGE_CACHE_BACKEND', 'memory')
+app.config['PAGE_CACHE_ENDPOINTS'] = ['homepage', 'users_show',
+                                      'messages_show']
+app.config['PAGE_CACHE_SIZE'] = int(os.environ.get('PAGE_CACHE_SIZE', 1000))
+app.config['PAGE_CACHE_TTL'] = float(os.environ.get('PAGE_CACHE_TTL', 10))
+app.config['PAGE_CACHE_STALE'] = float(os.environ.get('PAGE_CACHE_STALE', 60))
+
+# Mixed into every ETag (see httpcache), so pages cached by browsers are
+# rendered again after a deploy; defaults to a hash of the code and templates
+app.config['BUILD_VERSION'] = (os.environ.get('BUILD_VERSION')
+                               or source_version(app))
+
+# Who may scrape /metrics: clients sending METRICS_TOKEN as a bearer token,
+# and clients at METRICS_ALLOWED_IPS (comma separated). Behind
+# METRICS_PROXY_COUNT trusted proxies the client address is taken from
+# X-Forwarded-For; otherwise it is the connecting peer, which behind a
+# proxy on the same host is 127.0.0.1 for everyone. With neither a token
+# nor addresses configured, /metrics is off.
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+app.config['METRICS_ALLOWED_IPS'] = [
+    ip for ip in os.environ.get('METRICS_ALLOWED_IPS', '').split(',') if ip]
+app.config['METRICS_PROXY_COUNT'] = int(
+    os.environ.get('METRICS_PROXY_COUNT', 0))
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+request_metrics.init_app(app)
+assets.init_app(app)
+password_hasher.init_app(app)
+login_throttle.init_app(app, db)
+page_cache.init_app(app, db, CURR_USER_KEY)
+
+user_cache = UserCache(maxsize=app.config['USER_CACHE_SIZE'],
+                       ttl=app.config['USER_CACHE_TTL'])
+message_fragments = FragmentCache(
+    maxsize=app.config['MESSAGE_FRAGMENT_CACHE_SIZE'])
+
+
+##############################################################################
+# Query plans
+#
+# The relationships each template reads off every message it renders. List
+# routes build their queries with messages_for() so these are loaded up
+# front, in the same query, and a page costs the same number of queries
+# whatever its size instead of one lazy load per message author.
+
+MESSAGE_LIST_LOADS = (joinedload(Message.user),)
+
+TEMPLATE_LOADS = {
+    'home.html': MESSAGE_LIST_LOADS,
+    'users/show.html': MESSAGE_LIST_LOADS,
+    'users/likes.html': MESSAGE_LIST_LOADS,
+    'messages/show.html': MESSAGE_LIST_LOADS,
+}
+
+
+def messages_for(template):
+    """Message query that eager-loads what `template` needs."""
+
+    return Message.query.options(*TEMPLATE_LOADS[template])
+
+
+##############################################################################
+# Fragment caching
+#
+# Message list items are the same for every viewer apart from the like
+# button, so templates render the rest through message_fragment() and it is
+# cached per message (see fragments). Deleting a message or editing a
+# profile drops the affected fragments from this worker's cache.
+
+
+@app.template_global()
+def message_fragment(msg):
+    """The viewer-independent HTML of a message list item, cached per
+    message and rendered again when its author's name or avatar changes."""
+
+    author = msg.user
+    body = get_template_attribute('users/macros.html', 'message_body')
+
+    return message_fragments.get(
+        msg.id, (author.username, author.image_url, assets.version),
+        author.id, lambda: body(msg))
+
+
+##############################################################################
+# HTTP validators
+#
+# ETags for @conditional routes (see httpcache). A page changes only when
+# one of the users it shows changes, and every change to a user - profile,
+# counters, and through those their messages, likes and follows - gives them
+# a new User.version. So the ETags are built from versions: the profile's,
+# the viewer's (follow buttons, like buttons, navbar), and for user lists
+# the highest version among the listed users.
+#
+# The validators load the users they take versions from, and the view then
+# renders those same rows (see User.by_id), so a page never carries an ETag
+# for content newer than what it shows.
+
+
+def viewer_etag(*parts, user_ids=()):
+    """ETag for a page showing `user_ids`, as seen by the session's user;
+    None if the first of `user_ids` doesn't exist.
+
+    Also None where users aren't versioned (databases other than Postgres).
+    """
+
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return None
+
+    viewer_id = session.get(CURR_USER_KEY)
+    users = User.by_id([*user_ids, viewer_id])
+
+    if user_ids and user_ids[0] not in users:
+        return None
+
+    def version(user_id):
+        return users[user_id].version if user_id in users else None
+
+    # pages link the current build's assets, so a new build changes them too
+    return make_etag(*parts, [version(user_id) for user_id in user_ids],
+                     viewer_id, version(viewer_id), assets.version)
+
+
+def profile_etag(user_id):
+    return viewer_etag(user_ids=[user_id])
+
+
+def follows_etag(user_id, shown, owner):
+    """ETag for a list of the users related to `user_id` by follows: those
+    whose `shown` column is the user's id where `owner` is `user_id`."""
+
+    newest = (db.session.query(db.func.max(User.version))
+              .join(Follows, shown == User.id)
+              .filter(owner == user_id)
+              .scalar())
+
+    return viewer_etag(newest, user_ids=[user_id])
+
+
+def following_etag(user_id):
+    return follows_etag(user_id, Follows.user_being_followed_id,
+                        Follows.user_following_id)
+
+
+def followers_etag(user_id):
+    return follows_etag(user_id, Follows.user_following_id,
+                        Follows.user_being_followed_id)
+
+
+def message_etag(message_id):
+    """Messages never change, so the page only depends on its author."""
+
+    author_id = (db.session.query(Message.user_id)
+                 .filter(Message.id == message_id)
+                 .scalar())
+
+    return author_id and viewer_etag(message_id, user_ids=[author_id])
 
 
 ##############################################################################
@@ -32,13 +274,53 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    g.user is loaded lazily, on first use, so requests that never look at it
+    (static files, redirects) don't pay for it.
+    """
+
+    g.user = LocalProxy(load_curr_user)
+
+
+def load_curr_user():
+    """Load the logged in user (or None) once per request, through the
+    per-process user cache."""
+
+    if '_user' not in g:
+        g._user = None
+
+        if CURR_USER_KEY in session:
+            g._user = user_cache.load(session[CURR_USER_KEY])
+
+    return g._user
 
-    else:
-        g.user = None
+
+@app.errorhandler(ObjectDeletedError)
+def cached_user_deleted(error):
+    """A cached logged in user was deleted by another worker, so loading
+    their counters found no row: treat the request as logged out."""
+
+    db.session.rollback()
+    user_id = session.get(CURR_USER_KEY)
+
+    if user_id is None or User.query.filter_by(id=user_id).count():
+        raise error
+
+    user_cache.invalidate(user_id)
+    do_logout()
+    return redirect(request.url if request.method == 'GET' else '/')
+
+
+@app.after_request
+def expire_cached_user(resp):
+    """After a logged in user changes something, drop their cached copy
+    (their stored counters may have moved)."""
+
+    if request.method != 'GET' and CURR_USER_KEY in session:
+        user_cache.invalidate(session[CURR_USER_KEY])
+
+    return resp
 
 
 def check_g_user(func):
@@ -47,12 +329,59 @@ def check_g_user(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
         if not g.user:
+            if wants_json():
+                return jsonify(error="Access unauthorized."), 401
             flash("Access unauthorized.", "danger")
             return redirect("/")
         return func(*args, **kwargs)
     return wrapper
 
 
+def wants_json():
+    """Did the client (e.g. our scripts' fetch() calls) ask for JSON rather
+    than a page?"""
+
+    best = request.accept_mimetypes.best_match(['text/html',
+                                                'application/json'])
+    return best == 'application/json'
+
+
+def viewer_following_ids(user_ids):
+    """Which of `user_ids` the logged-in user follows, loaded in one query.
+
+    Passed to users/detail.html and the display_cards macro so each follow
+    button is a set lookup.
+    """
+
+    if not g.user:
+        return set()
+
+    return g.user.following_ids_among(user_ids)
+
+
+def stream_template(template_name, **context):
+    """Like render_template, but yields the page as it renders.
+
+    (Flask only grew its own stream_template in 2.2.)
+    """
+
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    return Response(stream_with_context(template.generate(context)))
+
+
+def viewer_liked_ids(messages):
+    """Ids of `messages` the logged-in user has liked, loaded in one query.
+
+    Passed to the messages_on_profile macro to pick each like button's state.
+    """
+
+    if not g.user:
+        return set()
+
+    return g.user.liked_ids_among(msg.id for msg in messages)
+
+
 def do_login(user):
     """Log in user."""
 
@@ -93,6 +422,7 @@ def signup():
             form.username.errors.append('Username taken—please pick another.')
             return render_template('users/signup.html', form=form)
 
+        username_index.add(user.username, user.id)
         do_login(user)
         return redirect("/")
 
@@ -111,10 +441,20 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
+        if not login_throttle.allow(form.username.data):
+            flash("Too many login attempts. Please wait a minute and try again.",
+                  'danger')
+            return render_template('users/login.html',
+                                   form=form,
+                                   title="Welcome back.",
+                                   button="Login"), 429
+
         user = User.authenticate(form.username.data,
                                  form.password.data)
 
         if user:
+            # saves the password if authenticate() rehashed it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -145,53 +485,131 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username; results
+    are ranked (see User.search) and paginated with a 'page' param.
+
+    Without 'q', lists users in id order a page at a time, continuing after
+    the id in the 'after' param.
     """
 
     search = request.args.get('q')
+    next_url = None
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    if search:
+        page = max(request.args.get('page', 1, type=int), 1)
+        users = (User.search(search)
+                 .offset((page - 1) * USERS_PER_PAGE)
+                 .limit(USERS_PER_PAGE + 1)
+                 .all())
+
+        if len(users) > USERS_PER_PAGE:
+            users = users[:USERS_PER_PAGE]
+            next_url = url_for('list_users', q=search, page=page + 1)
+
+        return render_template('users/index.html',
+                               users=users,
+                               following_ids=viewer_following_ids(
+                                   user.id for user in users),
+                               next_url=next_url)
+
+    # Find the page's ids first (an index-only range scan), so the follow
+    # state and next link are known before any cards render.
+    after = request.args.get('after', 0, type=int)
+    user_ids = [id for (id,) in (db.session.query(User.id)
+                                 .filter(User.id > after)
+                                 .order_by(User.id)
+                                 .limit(USERS_PER_PAGE + 1))]
+
+    if len(user_ids) > USERS_PER_PAGE:
+        user_ids = user_ids[:USERS_PER_PAGE]
+        next_url = url_for('list_users', after=user_ids[-1])
+
+    users = []
+    if user_ids:
+        users = User.query.filter(User.id.in_(user_ids)).order_by(User.id)
 
-    return render_template('users/index.html', users=users)
+    context = dict(following_ids=viewer_following_ids(user_ids),
+                   next_url=next_url)
+
+    if app.config['STREAM_USER_DIRECTORY'] and user_ids:
+        return stream_template('users/index.html',
+                               users=users.yield_per(USERS_PER_PAGE),
+                               **context)
+
+    return render_template('users/index.html', users=list(users), **context)
+
+
+@app.route('/users/autocomplete')
+def autocomplete_users():
+    """JSON list of users whose username starts with the 'q' param.
+
+    Answered from the in-memory prefix index rather than the database.
+    """
+
+    prefix = request.args.get('q', '')
+    limit = min(request.args.get('limit', 10, type=int), 50)
+
+    matches = username_index.search(prefix, limit) if prefix else []
+
+    return jsonify(users=[{'id': id, 'username': username}
+                          for username, id in matches])
 
 
 @app.route('/users/<int:user_id>')
+@conditional(profile_etag)
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile.
+
+    Messages come newest first from the database a page at a time; pass the
+    `before` cursor from the "load more" link to get older ones.
+    """
 
     user = User.query.get_or_404(user_id)
 
-    ### INSTEAD USED JINJA SORT ON user.messages ###
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    # messages = (Message
-    #             .query
-    #             .filter(Message.user_id == user_id)
-    #             .order_by(Message.timestamp.desc())
-    #             .limit(100)
-    #             .all())
-    return render_template('users/show.html', user=user)
+    messages, next_cursor = keyset_page(
+        messages_for('users/show.html').filter(Message.user_id == user_id),
+        (Message.timestamp, Message.id),
+        decode_cursor(request.args.get('before')),
+        MESSAGES_PER_PAGE,
+        key=lambda msg: (msg.timestamp, msg.id))
+
+    next_url = next_cursor and url_for('users_show',
+                                       user_id=user_id,
+                                       before=next_cursor)
+    return render_template('users/show.html',
+                           user=user,
+                           messages=messages,
+                           following_ids=viewer_following_ids([user.id]),
+                           liked_ids=viewer_liked_ids(messages),
+                           next_url=next_url)
 
 
 @app.route('/users/<int:user_id>/following')
 @check_g_user
+@conditional(following_etag)
 def show_following(user_id):
     """Show list of people this user is following."""
    
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    return render_template('users/following.html',
+                           user=user,
+                           following_ids=viewer_following_ids(
+                               [user.id] + [followed.id
+                                            for followed in user.following]))
 
 
 @app.route('/users/<int:user_id>/followers')
 @check_g_user
+@conditional(followers_etag)
 def users_followers(user_id):
     """Show list of followers of this user."""
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    return render_template('users/followers.html',
+                           user=user,
+                           following_ids=viewer_following_ids(
+                               [user.id] + [follower.id
+                                            for follower in user.followers]))
 
 
 @app.route('/users/<int:user_id>/likes')
@@ -200,30 +618,98 @@ def users_likes(user_id):
     """Show list of likes of this user."""
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user)
+    messages = (messages_for('users/likes.html')
+                .join(Likes, Likes.message_id == Message.id)
+                .filter(Likes.user_id == user_id)
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .all())
+
+    return render_template('users/likes.html',
+                           user=user,
+                           messages=messages,
+                           following_ids=viewer_following_ids([user.id]),
+                           liked_ids=viewer_liked_ids(messages))
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
 @check_g_user
 def add_follow(follow_id):
-    """Add a follow for the currently-logged-in user."""
+    """Add a follow for the currently-logged-in user.
+
+    Following someone already followed changes nothing; following yourself
+    is a 400. Scripts asking for JSON get {"following": true} back instead
+    of a redirect.
+    """
+
+    if follow_id == g.user.id:
+        abort(400)
+
+    followed = Follows.follow(g.user.id, [follow_id])
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    if not followed and not User.query.filter_by(id=follow_id).count():
+        db.session.rollback()
+        abort(404)
+
+    TimelineEntry.add_authors(g.user.id, followed)
+    db.session.commit()
+
+    if wants_json():
+        return jsonify(following=True)
+
+    return redirect(url_for('show_following', user_id= g.user.id))
+
+
+@app.route('/users/follow', methods=['POST'])
+@check_g_user
+def add_follows():
+    """Follow many users at once: `ids` from a JSON body ({"ids": [...]})
+    or repeated form fields, at most MAX_BULK_FOLLOWS of them.
+
+    One statement adds the follows, one backfills the timeline and one
+    trims it, however many ids there are. Scripts asking for JSON get the ids newly followed.
+    Anything but a list of integer ids is a 400.
+    """
+
+    if request.is_json:
+        data = request.get_json(silent=True)
+        ids = data.get('ids') if isinstance(data, dict) else None
+        valid = (isinstance(ids, list)
+                 and all(type(follow_id) is int for follow_id in ids))
+    else:
+        ids = request.form.getlist('ids')
+        valid = all(follow_id.isascii() and follow_id.isdigit()
+                    for follow_id in ids)
+        ids = [int(follow_id) for follow_id in ids] if valid else ids
+
+    if not valid or not ids or len(ids) > MAX_BULK_FOLLOWS:
+        abort(400)
+
+    followed = Follows.follow(g.user.id, set(ids))
+    TimelineEntry.add_authors(g.user.id, followed)
     db.session.commit()
 
+    if wants_json():
+        return jsonify(followed=sorted(followed))
+
     return redirect(url_for('show_following', user_id= g.user.id))
 
 
 @app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 @check_g_user
 def stop_following(follow_id):
-    """Have currently-logged-in-user stop following this user."""
+    """Have currently-logged-in-user stop following this user.
+
+    Unfollowing someone not followed changes nothing. Scripts asking for
+    JSON get {"following": false} back instead of a redirect.
+    """
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    if Follows.unfollow(g.user.id, follow_id):
+        TimelineEntry.remove_author(g.user.id, follow_id)
     db.session.commit()
 
+    if wants_json():
+        return jsonify(following=False)
+
     return redirect(url_for('show_following', user_id= g.user.id))
 
 
@@ -236,6 +722,7 @@ def profile():
 
     if form.validate_on_submit():
         if User.authenticate(g.user.username, form.password.data):
+            old_username = g.user.username
             g.user.username = form.username.data
             g.user.email = form.email.data
             g.user.image_url = form.image_url.data
@@ -243,6 +730,14 @@ def profile():
             g.user.bio = form.bio.data
 
             db.session.commit()
+
+            user_cache.invalidate(g.user.id)
+            message_fragments.invalidate_group(g.user.id)
+
+            if g.user.username != old_username:
+                username_index.remove(old_username, g.user.id)
+                username_index.add(g.user.username, g.user.id)
+
             flash(f"{g.user.username}'s profile was edited.", "info")
             return redirect (url_for("users_show", user_id=g.user.id))
         
@@ -259,6 +754,9 @@ def delete_user():
 
     do_logout()
 
+    username_index.remove(g.user.username, g.user.id)
+    user_cache.invalidate(g.user.id)
+    message_fragments.invalidate_group(g.user.id)
     db.session.delete(g.user)
     db.session.commit()
 
@@ -271,16 +769,23 @@ def delete_user():
 @app.route('/users/add_like/<int:message_id>', methods=["POST"])
 @check_g_user
 def like_message(message_id):
-    """Handles user liking messages."""
-    
-    message = Message.query.get(message_id)
+    """Handles user liking messages: likes the message, or unlikes it if
+    already liked.
 
-    if message in g.user.likes:
-        g.user.likes.remove(message)
-    else:
-        g.user.likes.append(message)
+    Scripts asking for JSON get the new state and like count back, so they
+    can update the button in place; forms are redirected home.
+    """
+
+    try:
+        (liked, likes) = Likes.toggle(g.user.id, message_id)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        abort(404)
+
+    if wants_json():
+        return jsonify(liked=liked, likes=likes)
 
-    db.session.commit()
     return redirect('/')
 
 
@@ -298,8 +803,11 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        # not g.user.messages.append(), which would load all their messages
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        TimelineEntry.fan_out(msg)
         db.session.commit()
 
         flash ('Added message!', 'info')
@@ -309,10 +817,11 @@ def messages_add():
 
 
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@conditional(message_etag)
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get_or_404(message_id)
+    msg = messages_for('messages/show.html').get_or_404(message_id)
     return render_template('messages/show.html', message=msg)
 
 
@@ -323,8 +832,10 @@ def messages_destroy(message_id):
     
     msg = Message.query.get_or_404(message_id)
     if (g.user.id == msg.user_id):
+        TimelineEntry.remove_message(msg.id)
         db.session.delete(msg)
         db.session.commit()
+        message_fragments.invalidate(message_id)
 
         flash ('Deleted message!', 'info')
         return redirect (url_for("users_show", user_id=g.user.id))
@@ -341,23 +852,194 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, read from the
+      user's materialized timeline a page at a time; pass the `before`
+      cursor from the "load more" link to get older messages
     """
 
     if g.user:
-        following_ids = [user.id for user in g.user.following]
-        following_ids.append(g.user.id)
-        messages = (Message.query.filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        return render_template('home.html', messages=messages)
+        timeline = (messages_for('home.html')
+                    .join(TimelineEntry,
+                          TimelineEntry.message_id == Message.id)
+                    .filter(TimelineEntry.user_id == g.user.id))
+        messages, next_cursor = keyset_page(
+            timeline,
+            (TimelineEntry.timestamp, TimelineEntry.message_id),
+            decode_cursor(request.args.get('before')),
+            MESSAGES_PER_PAGE,
+            key=lambda msg: (msg.timestamp, msg.id))
+
+        next_url = next_cursor and url_for('homepage', before=next_cursor)
+        return render_template('home.html',
+                               messages=messages,
+                               liked_ids=viewer_liked_ids(messages),
+                               next_url=next_url)
 
     else:
         return render_template('home-anon.html')
 
 
+##############################################################################
+# Metrics
+
+
+@app.route('/metrics')
+def metrics():
+    """Request and component metrics in Prometheus text format.
+
+    Internal: only answers METRICS_TOKEN or the METRICS_ALLOWED_IPS.
+    """
+
+    token = app.config['METRICS_TOKEN']
+    sent = request.headers.get('Authorization', '')
+    has_token = bool(token) and hmac.compare_digest(
+        sent.encode(), f'Bearer {token}'.encode())
+
+    allowed_ip = (client_ip(app.config['METRICS_PROXY_COUNT'])
+                  in app.config['METRICS_ALLOWED_IPS'])
+
+    if not (has_token or allowed_ip):
+        abort(404)
+
+    return Response(request_metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+@request_metrics.add_collector
+def component_metrics():
+    """Gauges and counters from the password hasher, login throttle, user
+    cache, message fragment cache, page cache and database pools."""
+
+    hasher = password_hasher.stats()
+    throttle = login_throttle.stats()
+    pages = page_cache.stats()
+    pools = pool_stats.stats()
+    routing = db.stats()
+
+    return [
+        ('warbler_bcrypt_pending', 'gauge',
+         "bcrypt jobs queued or running.", hasher['pending']),
+        ('warbler_bcrypt_peak_pending', 'gauge',
+         "Most bcrypt jobs ever queued or running at once.",
+         hasher['peak_pending']),
+        ('warbler_bcrypt_completed_total', 'counter',
+         "bcrypt jobs finished.", hasher['completed']),
+        ('warbler_bcrypt_seconds_total', 'counter',
+         "Time bcrypt jobs took, including queueing.", hasher['seconds']),
+        ('warbler_login_allowed_total', 'counter',
+         "Login attempts let through the throttle.", throttle['allowed']),
+        ('warbler_login_shed_by_username_total', 'counter',
+         "Login attempts refused by the per-username limit.",
+         throttle['shed_by_username']),
+        ('warbler_login_shed_by_ip_total', 'counter',
+         "Login attempts refused by the per-IP limit.",
+         throttle['shed_by_ip']),
+        ('warbler_user_cache_hits_total', 'counter',
+         "Logged-in user loads served from the cache.", user_cache.hits),
+        ('warbler_user_cache_misses_total', 'counter',
+         "Logged-in user loads that queried the database.",
+         user_cache.misses),
+        ('warbler_message_fragment_hits_total', 'counter',
+         "Message list items served from the fragment cache.",
+         message_fragments.hits),
+        ('warbler_message_fragment_misses_total', 'counter',
+         "Message list items rendered.", message_fragments.misses),
+        ('warbler_message_fragments', 'gauge',
+         "Message list items in the fragment cache.", len(message_fragments)),
+        ('warbler_page_cache_hits_total', 'counter',
+         "Anonymous pages served fresh from the page cache.", pages['hits']),
+        ('warbler_page_cache_stale_hits_total', 'counter',
+         "Anonymous pages served stale while re-rendered.",
+         pages['stale_hits']),
+        ('warbler_page_cache_misses_total', 'counter',
+         "Anonymous pages rendered on the request.", pages['misses']),
+        ('warbler_db_pool_checkouts_total', 'counter',
+         "Connections checked out of the database pools.",
+         pools['checkouts']),
+        ('warbler_db_pool_wait_seconds_total', 'counter',
+         "Time spent waiting to check out a connection.",
+         pools['wait_seconds']),
+        ('warbler_db_pool_max_wait_seconds', 'gauge',
+         "Longest wait to check out a connection.",
+         pools['max_wait_seconds']),
+        ('warbler_db_pool_checked_out', 'gauge',
+         "Connections in use from the primary's pool.",
+         getattr(db.engine.pool, 'checkedout', lambda: 0)()),
+        ('warbler_db_replica_reads_total', 'counter',
+         "Requests whose reads went to a replica.", routing['replica_reads']),
+        ('warbler_db_primary_reads_total', 'counter',
+         "Replica-routed requests read from the primary after a write.",
+         routing['primary_reads']),
+    ]
+
+
+##############################################################################
+# CLI commands
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    """Recompute every user's home timeline from messages and follows."""
+
+    TimelineEntry.rebuild()
+    db.session.commit()
+    print(f"Rebuilt timelines: {TimelineEntry.query.count()} entries.")
+
+
+@app.cli.command('prune-timelines')
+@click.option('--batch-size', default=1000, show_default=True,
+              help="Users whose timelines are pruned per transaction.")
+def prune_timelines(batch_size):
+    """Cut every home timeline back to its newest entries.
+
+    Posting doesn't prune followers' timelines, so run this periodically
+    (e.g. from cron) to keep them bounded.
+    """
+
+    deleted = TimelineEntry.prune_all(batch_size)
+    print(f"Pruned timelines: {deleted} entries deleted.")
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters():
+    """Recompute every user's message/follow/like counters."""
+
+    User.reconcile_counters()
+    db.session.commit()
+    print(f"Reconciled counters for {User.query.count()} users.")
+
+
+@app.cli.command('migrate')
+@click.option('--stamp', is_flag=True,
+              help="Record all migrations as applied without running them "
+                   "(for a database made with db.create_all()).")
+def migrate(stamp):
+    """Apply pending schema migrations (see migrations/)."""
+
+    if stamp:
+        migrations.stamp(db.engine)
+        print("Stamped all migrations as applied.")
+        return
+
+    applied = migrations.upgrade(db.engine)
+    print(f"Applied {len(applied)} migration(s).")
+
+
+@app.cli.command('check-query-plans')
+def check_plans():
+    """Check the hot queries use their indexes (see explain.py)."""
+
+    failures = check_query_plans()
+
+    for name, (index, used) in failures.items():
+        print(f"{name}: expected {index}, plan uses {sorted(used) or 'no index'}")
+
+    if failures:
+        raise SystemExit(1)
+
+    print("All hot queries use their indexes.")
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -367,10 +1049,17 @@ def homepage():
 
 @app.after_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request, unless the route chose its
+    own caching policy (see httpcache). Pages for a logged in user are also
+    marked private, so shared proxies never keep them."""
+
+    if 'Cache-Control' in req.headers:
+        return req
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    if CURR_USER_KEY in session:
+        req.headers["Cache-Control"] = "private, no-store"
+    else:
+        req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
     req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
     return req
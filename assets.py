@@ -0,0 +1,265 @@
+"""Fingerprinted, precompressed static assets.
+
+build() copies the files under static/ into static/dist/ with a hash of
+their content in the name (style.css -> style.3f2a1b4c5d6e.css), rewriting
+the /static/ URLs inside stylesheets to match, and writes gzip (and, when
+the brotli package is installed, brotli) versions of the text files next
+to them. The CDN libraries in VENDOR can be downloaded into the build too.
+A manifest maps every original name to its built one.
+
+At runtime templates link assets through static_url(), which uses the
+manifest when there is one and otherwise falls back to the plain /static/
+URL (or, for vendored libraries, to the CDN). Built files never change
+under a given name, so they are served with a one-year immutable
+Cache-Control, compressed when the client accepts it.
+"""
+
+import gzip
+import json
+import mimetypes
+import os
+import re
+import shutil
+from hashlib import sha256
+from io import BytesIO
+from urllib.request import urlopen
+
+from flask import abort, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# libraries the templates load from a CDN, by the name they're vendored as
+VENDOR = {
+    'vendor/bootstrap.css':
+        'https://unpkg.com/bootstrap/dist/css/bootstrap.css',
+    'vendor/jquery.js': 'https://unpkg.com/jquery',
+    'vendor/popper.js': 'https://unpkg.com/popper',
+    'vendor/bootstrap.js': 'https://unpkg.com/bootstrap',
+}
+
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt'}
+
+# (Accept-Encoding value, file suffix), in order of preference
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+MANIFEST = 'manifest.json'
+
+ONE_YEAR = 365 * 24 * 60 * 60
+
+CSS_URL = re.compile(r"""url\((['"]?)/static/([^'")?#]+)""")
+
+
+##############################################################################
+# Build
+
+
+def build(static_dir, out_dir, vendor=False, log=print):
+    """Build every file under `static_dir` (and, with `vendor`, the VENDOR
+    libraries) into `out_dir`, replacing what was there. Returns the
+    manifest."""
+
+    if os.path.isdir(out_dir):
+        shutil.rmtree(out_dir)
+    os.makedirs(out_dir)
+
+    sources = {}
+    for root, dirs, files in os.walk(static_dir):
+        if os.path.abspath(root).startswith(os.path.abspath(out_dir)):
+            continue
+
+        for filename in files:
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, static_dir).replace(os.sep, '/')
+            with open(path, 'rb') as source:
+                sources[name] = source.read()
+
+    if vendor:
+        for name, url in VENDOR.items():
+            log(f"Downloading {url}")
+            with urlopen(url) as response:
+                sources[name] = response.read()
+
+    manifest = {'files': {}, 'compressed': {}}
+
+    # stylesheets last, so the URLs in them can be rewritten to built names
+    order = sorted(sources, key=lambda name: (name.endswith('.css'), name))
+    for name in order:
+        content = sources[name]
+        if name.endswith('.css'):
+            content = rewrite_css(content, manifest['files'])
+
+        built = fingerprint(name, content)
+        write(out_dir, built, content)
+        manifest['files'][name] = built
+
+        encodings = compress(out_dir, built, content)
+        if encodings:
+            manifest['compressed'][built] = encodings
+
+        log(f"{name} -> {built} {' '.join(encodings)}")
+
+    with open(os.path.join(out_dir, MANIFEST), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def fingerprint(name, content):
+    """`name` with a hash of `content` before its extension."""
+
+    root, ext = os.path.splitext(name)
+    return f"{root}.{sha256(content).hexdigest()[:12]}{ext}"
+
+
+def rewrite_css(content, built):
+    """Point the /static/ URLs in a stylesheet at their built files."""
+
+    def replace(match):
+        quote, name = match.groups()
+        if name not in built:
+            return match.group(0)
+        return f"url({quote}/static/dist/{built[name]}"
+
+    return CSS_URL.sub(replace, content.decode()).encode()
+
+
+def compress(out_dir, name, content):
+    """Write compressed copies of a text file, where they're smaller.
+    Returns the encodings written."""
+
+    if os.path.splitext(name)[1] not in COMPRESSIBLE:
+        return []
+
+    compressed = {'gzip': gzip_compress(content)}
+    if brotli is not None:
+        compressed['br'] = brotli.compress(content)
+
+    encodings = []
+    for encoding, suffix in ENCODINGS:
+        data = compressed.get(encoding)
+        if data is not None and len(data) < len(content):
+            write(out_dir, name + suffix, data)
+            encodings.append(encoding)
+
+    return encodings
+
+
+def gzip_compress(content):
+    """gzip `content` with a fixed mtime, so builds are reproducible.
+
+    (gzip.compress() only takes mtime from Python 3.8.)
+    """
+
+    out = BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=9,
+                       mtime=0) as gz:
+        gz.write(content)
+    return out.getvalue()
+
+
+def write(out_dir, name, content):
+    path = os.path.join(out_dir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as out:
+        out.write(content)
+
+
+##############################################################################
+# Serving
+
+
+class Assets:
+    """Links and serves the built assets of a Flask app."""
+
+    def __init__(self):
+        self.directory = None
+        self.files = {}
+        self.compressed = {}
+        self.built = set()
+        self.version = None
+
+    def init_app(self, app):
+        """Add the static_url() template global and the route serving
+        /static/dist/, and load the manifest from ASSETS_DIR if built."""
+
+        app.config.setdefault('ASSETS_DIR',
+                              os.path.join(app.static_folder, 'dist'))
+
+        app.add_template_global(self.static_url)
+        app.add_url_rule('/static/dist/<path:filename>', 'assets',
+                         self.send)
+
+        self.load(app.config['ASSETS_DIR'])
+
+    def load(self, directory):
+        """Use the build in `directory`; without one, fall back to plain
+        static files."""
+
+        self.directory = directory
+        self.files, self.compressed, self.built = {}, {}, set()
+        self.version = None
+
+        path = os.path.join(directory, MANIFEST)
+        if not os.path.exists(path):
+            return
+
+        with open(path, 'rb') as manifest_file:
+            content = manifest_file.read()
+
+        manifest = json.loads(content.decode())
+        self.files = manifest['files']
+        self.compressed = manifest['compressed']
+        self.built = set(self.files.values())
+        self.version = sha256(content).hexdigest()[:12]
+
+    def static_url(self, name):
+        """URL of a static file, by its name under static/.
+
+        Also takes /static/... URLs (as stored for default user images),
+        and passes any other URL (or a missing one) through unchanged.
+        """
+
+        if not name:
+            return name
+
+        if name.startswith('/static/'):
+            name = name[len('/static/'):]
+        elif name.startswith('/') or '://' in name:
+            return name
+
+        if name in self.files:
+            return url_for('assets', filename=self.files[name])
+        if name in VENDOR:
+            return VENDOR[name]
+        return url_for('static', filename=name)
+
+    def send(self, filename):
+        """Serve a built file, precompressed if the client accepts that."""
+
+        if filename not in self.built:
+            abort(404)
+
+        mimetype = mimetypes.guess_type(filename)[0]
+        encodings = self.compressed.get(filename, [])
+
+        for encoding, suffix in ENCODINGS:
+            if encoding in encodings and request.accept_encodings[encoding]:
+                response = send_from_directory(
+                    self.directory, filename + suffix, mimetype=mimetype)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(self.directory, filename,
+                                           mimetype=mimetype)
+
+        if encodings:
+            response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = (
+            f'public, max-age={ONE_YEAR}, immutable')
+        return response
+
+
+assets = Assets()
@@ -0,0 +1,266 @@
+"""Benchmark Warbler's hot routes against a generated dataset.
+
+    createdb warbler-bench
+    python benchmarks.py                                  # small dataset
+    python benchmarks.py --users 100000 --messages 2000000 --follows 5000000
+    python benchmarks.py --reuse --save baseline.json     # keep the data
+    python benchmarks.py --reuse --compare baseline.json
+
+Each route is driven through app.test_client() as randomly picked users and
+reports p50/p95/p99 latency, SQL statements per request and peak Python
+memory per request (measured in a separate, tracemalloc-ed pass, so tracing
+doesn't skew the timings).
+
+The database is DATABASE_URL, default postgresql:///warbler-bench. Unless
+--reuse is given it is reset and loaded with a fresh dataset from
+generator/create_csvs.py. --compare exits non-zero when a route's p95 got
+slower by more than --tolerance or it runs more queries than the baseline.
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import tracemalloc
+from argparse import ArgumentParser
+from datetime import datetime
+from math import ceil
+from random import Random
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler-bench")
+
+from app import app, CURR_USER_KEY
+from loader import load
+from models import db, User, Message, Follows, Likes
+from querylog import QueryLog
+
+GENERATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'generator', 'create_csvs.py')
+
+# route name -> (method, path, form data) for a request, given a Sampler
+ROUTES = {
+    'home': lambda s: ('GET', '/', None),
+    'profile': lambda s: ('GET', f'/users/{s.user_id()}', None),
+    'search': lambda s: ('GET', f'/users?q={s.username()[:3]}', None),
+    'followers': lambda s: ('GET', f'/users/{s.user_id()}/followers', None),
+    'like': lambda s: ('POST', f'/users/add_like/{s.message_id()}', None),
+    'new_message': lambda s: ('POST', '/messages/new',
+                              {'text': 'Benchmarking!'}),
+}
+
+
+class Sampler:
+    """Random users and messages from the loaded dataset, reproducibly."""
+
+    def __init__(self, seed):
+        self.random = Random(seed)
+        self.users = db.session.query(User.id, User.username).all()
+
+        # each like goes to a different, not yet liked message, so the
+        # route always measures adding a like
+        self.messages = [id for (id,) in (db.session.query(Message.id)
+                                          .outerjoin(Likes)
+                                          .filter(Likes.id.is_(None)))]
+        self.random.shuffle(self.messages)
+
+    def user_id(self):
+        return self.random.choice(self.users)[0]
+
+    def username(self):
+        return self.random.choice(self.users)[1]
+
+    def message_id(self):
+        return self.messages.pop()
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile."""
+
+    ordered = sorted(values)
+    return ordered[max(0, ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def request(client, route, sampler):
+    """Make one request to `route` as a random user.
+
+    Returns (seconds, QueryLog).
+    """
+
+    method, path, data = ROUTES[route](sampler)
+
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = sampler.user_id()
+
+    with QueryLog(db.engine) as log:
+        start = perf_counter()
+        resp = client.open(path, method=method, data=data)
+        resp.get_data()
+        seconds = perf_counter() - start
+
+    if resp.status_code >= 400:
+        raise SystemExit(f"{method} {path} failed: {resp.status}")
+
+    return seconds, log
+
+
+def benchmark(client, route, sampler, requests, warmup, memory_requests):
+    """Measure `route`; returns its summary for the report/baseline."""
+
+    for _ in range(warmup):
+        request(client, route, sampler)
+
+    latencies = []
+    queries = []
+    db_seconds = []
+
+    for _ in range(requests):
+        seconds, log = request(client, route, sampler)
+        latencies.append(seconds * 1000)
+        queries.append(log.count)
+        db_seconds.append(log.seconds * 1000)
+
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(memory_requests):
+            tracemalloc.clear_traces()
+            request(client, route, sampler)
+            peaks.append(tracemalloc.get_traced_memory()[1] / 1024)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'requests': requests,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'db_ms': sum(db_seconds) / requests,
+        'queries': sum(queries) / requests,
+        'max_queries': max(queries),
+        'peak_kib': max(peaks, default=0),
+    }
+
+
+def load_dataset(args):
+    with TemporaryDirectory() as data_dir:
+        print("Generating dataset...")
+        subprocess.run([sys.executable, GENERATOR,
+                        '--users', str(args.users),
+                        '--messages', str(args.messages),
+                        '--follows', str(args.follows),
+                        '--likes', str(args.likes),
+                        '--seed', str(args.seed),
+                        '--out', data_dir], check=True)
+
+        print("Loading dataset...")
+        load(data_dir, log=lambda line: None)
+
+
+def print_report(results, baseline):
+    print(f"\n{'route':<12} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'db ms':>7} {'queries':>8} {'peak KiB':>9}  vs baseline p95")
+
+    for route, r in results.items():
+        line = (f"{route:<12} {r['p50_ms']:8.1f} {r['p95_ms']:8.1f} "
+                f"{r['p99_ms']:8.1f} {r['db_ms']:7.1f} {r['queries']:8.1f} "
+                f"{r['peak_kib']:9.0f}")
+
+        if route in baseline:
+            change = r['p95_ms'] / baseline[route]['p95_ms'] - 1
+            line += f"  {change:+.0%}"
+
+        print(line)
+
+
+def regressions(results, baseline, tolerance):
+    """Routes that got slower or chattier than `baseline`, with why."""
+
+    found = []
+
+    for route, r in results.items():
+        base = baseline.get(route)
+        if base is None:
+            continue
+
+        if r['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            found.append(f"{route}: p95 {base['p95_ms']:.1f} -> "
+                         f"{r['p95_ms']:.1f} ms")
+        if r['max_queries'] > base['max_queries']:
+            found.append(f"{route}: queries {base['max_queries']} -> "
+                         f"{r['max_queries']}")
+
+    return found
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=40000)
+    parser.add_argument('--likes', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--reuse', action='store_true',
+                        help="benchmark the data already in the database")
+    parser.add_argument('--routes', nargs='+', choices=ROUTES,
+                        default=list(ROUTES))
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--memory-requests', type=int, default=20)
+    parser.add_argument('--save', metavar='JSON',
+                        help="write the results as a baseline")
+    parser.add_argument('--compare', metavar='JSON',
+                        help="compare against a saved baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed p95 slowdown vs the baseline")
+    args = parser.parse_args()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    with app.app_context():
+        if not args.reuse:
+            load_dataset(args)
+
+        sampler = Sampler(args.seed)
+        client = app.test_client()
+
+        results = {}
+        for route in args.routes:
+            print(f"Benchmarking {route}...")
+            results[route] = benchmark(client, route, sampler, args.requests,
+                                       args.warmup, args.memory_requests)
+
+        dataset = {
+            'users': User.query.count(),
+            'messages': Message.query.count(),
+            'follows': Follows.query.count(),
+            'likes': Likes.query.count(),
+        }
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['routes']
+
+    print_report(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'created': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'dataset': dataset,
+                'routes': results,
+            }, f, indent=2)
+        print(f"\nSaved baseline to {args.save}")
+
+    found = regressions(results, baseline, args.tolerance)
+    if found:
+        print("\nRegressions:\n  " + "\n  ".join(found))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+"""Build fingerprinted, compressed static assets into static/dist.
+
+    python build_assets.py              # build static/ into static/dist/
+    python build_assets.py --vendor     # also download the CDN libraries
+
+The app picks the build up on its next start; see assets.py.
+"""
+
+import os
+from argparse import ArgumentParser
+
+from assets import build
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+parser = ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--static-dir', default=os.path.join(HERE, 'static'),
+                    help="directory of source files")
+parser.add_argument('--out', default=os.path.join(HERE, 'static', 'dist'),
+                    help="directory to build into (emptied first)")
+parser.add_argument('--vendor', action='store_true',
+                    help="download bootstrap, jquery and popper into the "
+                         "build instead of linking them from unpkg")
+args = parser.parse_args()
+
+build(args.static_dir, args.out, vendor=args.vendor)
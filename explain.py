@@ -0,0 +1,105 @@
+"""Check that Warbler's hot queries can be served by their indexes.
+
+    flask check-query-plans
+
+Each query below is EXPLAINed with sequential scans disabled, so the planner
+picks an index whenever one fits even on a small development database; a
+query whose plan still doesn't use the expected index has lost it (or was
+changed so it no longer matches it).
+"""
+
+import json
+
+from models import db
+
+# name -> (query, index it should use)
+HOT_QUERIES = {
+    'home timeline page': ("""
+        SELECT message_id FROM timeline_entries
+         WHERE user_id = 1
+           AND (timestamp, message_id) < ('2024-01-01', 1000)
+         ORDER BY timestamp DESC, message_id DESC
+         LIMIT 26
+    """, 'ix_timeline_entries_user_timestamp'),
+
+    'profile messages page': ("""
+        SELECT id FROM messages
+         WHERE user_id = 1
+           AND (timestamp, id) < ('2024-01-01', 1000)
+         ORDER BY timestamp DESC, id DESC
+         LIMIT 26
+    """, 'ix_messages_user_id_timestamp'),
+
+    'users followed by a user': ("""
+        SELECT user_being_followed_id FROM follows
+         WHERE user_following_id = 1
+    """, 'ix_follows_user_following_id'),
+
+    'followers of a user': ("""
+        SELECT user_following_id FROM follows
+         WHERE user_being_followed_id = 1
+    """, 'follows_pkey'),
+
+    'viewer follows among users': ("""
+        SELECT user_being_followed_id FROM follows
+         WHERE user_following_id = 1
+           AND user_being_followed_id IN (2, 3, 4)
+    """, 'ix_follows_user_following_id'),
+
+    "a user's likes": ("""
+        SELECT message_id FROM likes WHERE user_id = 1
+    """, 'uq_likes_user_id_message_id'),
+
+    'viewer likes among messages': ("""
+        SELECT message_id FROM likes
+         WHERE user_id = 1 AND message_id IN (2, 3, 4)
+    """, 'uq_likes_user_id_message_id'),
+
+    "a message's likes": ("""
+        SELECT user_id FROM likes WHERE message_id = 1
+    """, 'ix_likes_message_id'),
+}
+
+
+def plan_indexes(plan):
+    """Names of every index used anywhere in an EXPLAIN (FORMAT JSON) plan."""
+
+    found = set()
+    if 'Index Name' in plan:
+        found.add(plan['Index Name'])
+
+    for child in plan.get('Plans', []):
+        found |= plan_indexes(child)
+
+    return found
+
+
+def check_query_plans(engine=None):
+    """EXPLAIN every hot query.
+
+    Returns {name: (expected index, indexes used)} for the queries that
+    don't use their index; empty when all is well.
+    """
+
+    failures = {}
+
+    with (engine or db.engine).connect() as conn:
+        # plan from current statistics, not whatever was last gathered
+        conn.execute("ANALYZE timeline_entries, messages, follows, likes")
+
+        with conn.begin() as transaction:
+            conn.execute("SET LOCAL enable_seqscan = off")
+
+            for name, (query, index) in HOT_QUERIES.items():
+                explained = conn.execute(
+                    f"EXPLAIN (FORMAT JSON) {query}").scalar()
+                if isinstance(explained, str):
+                    explained = json.loads(explained)
+
+                used = plan_indexes(explained[0]['Plan'])
+                if index not in used:
+                    failures[name] = (index, used)
+
+            transaction.rollback()
+
+    return failures
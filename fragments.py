@@ -0,0 +1,92 @@
+"""Per-process cache of rendered HTML fragments for Warbler.
+
+Message list items look the same to every viewer except for the like
+button, and a popular message is rendered into a great many timelines. The
+viewer-independent part is rendered once and kept here; pages fill in only
+the like button per request.
+
+Each fragment is stored with a version of what it was rendered from (for a
+message: its author's username and avatar), and a lookup with a different
+version re-renders it. So an author's profile edit in another worker is
+never shown stale; invalidation in this worker just frees the memory early.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+from markupsafe import Markup
+
+
+class FragmentCache:
+    """LRU of rendered fragments, keyed by e.g. message id.
+
+    Holds at most `maxsize` fragments. Each also belongs to a group (e.g. the
+    message's author) so all of a group can be dropped at once.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._groups = {}
+        self._lock = Lock()
+
+    def get(self, key, version, group, render):
+        """The fragment for `key` at `version`, calling render() for its HTML
+        if it isn't cached."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and entry[0] == version:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry[2]
+
+            self.misses += 1
+
+        html = Markup(render())
+
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (version, group, html)
+            self._groups.setdefault(group, set()).add(key)
+
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+        return html
+
+    def invalidate(self, key):
+        """Drop the fragment for `key`, e.g. after its message was deleted."""
+
+        with self._lock:
+            self._remove(key)
+
+    def invalidate_group(self, group):
+        """Drop every fragment in `group`, e.g. after the author's profile
+        was edited."""
+
+        with self._lock:
+            for key in list(self._groups.get(group, ())):
+                self._remove(key)
+
+    def clear(self):
+        """Drop every fragment."""
+
+        with self._lock:
+            self._entries.clear()
+            self._groups.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+
+        if entry is not None:
+            keys = self._groups[entry[1]]
+            keys.discard(key)
+            if not keys:
+                del self._groups[entry[1]]
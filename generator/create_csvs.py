@@ -2,29 +2,42 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. a production-sized
+dataset for benchmarks:
+
+    python generator/create_csvs.py --users 1000000 --messages 20000000 \\
+        --follows 50000000 --likes 30000000 --out big-dataset
+
+Everything runs offline and is vectorized with NumPy; rows are written a
+chunk at a time. The same --seed and arguments always give the same files.
+
+Follower counts follow a power law (a few users are followed by many), as do
+how much users post, follow and like; likes go mostly to popular users'
+messages. Load the result with seed.py.
 """
 
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+from argparse import ArgumentParser
+
+import numpy as np
 from faker import Faker
-from helpers import get_random_datetime
+
+from helpers import power_law_weights, random_timestamps, unique_pairs
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
-
-fake = Faker()
+# hash of 'password', so every generated user can log in
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-# Generate random profile image URLs to use for users
+# Faker is too slow to call per row for millions of rows, so it fills pools
+# of values that rows pick from
+POOL_SIZE = 10000
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +45,138 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+    "/static/images/warbler-hero.jpg",
+    "/static/images/signed-out-home.jpg",
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+parser = ArgumentParser(description="Generate CSVs of random data for Warbler.")
+parser.add_argument('--users', type=int, default=300)
+parser.add_argument('--messages', type=int, default=1000)
+parser.add_argument('--follows', type=int, default=5000)
+parser.add_argument('--likes', type=int, default=2000)
+parser.add_argument('--power-law', type=float, default=1.0,
+                    help="exponent for follower counts; higher is more skewed")
+parser.add_argument('--end-date', default='2024-01-01',
+                    help="messages are spread over the two years before this")
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--chunk-size', type=int, default=100000)
+parser.add_argument('--out', default='generator')
+args = parser.parse_args()
+
+rng = np.random.default_rng(args.seed)
+
+fake = Faker()
+fake.seed_instance(args.seed)
+
+num_users = args.users
+user_ids = np.arange(1, num_users + 1)
+
+# who gets followed (and liked), and who posts, follows and likes
+popularity = power_law_weights(rng, num_users, args.power_law)
+activity = power_law_weights(rng, num_users, args.power_law / 2)
+
+names = np.array([fake.user_name() for _ in range(POOL_SIZE)])
+domains = np.array([f"@{fake.free_email_domain()}" for _ in range(POOL_SIZE)])
+bios = np.array([fake.sentence() for _ in range(POOL_SIZE)])
+cities = np.array([fake.city() for _ in range(POOL_SIZE)])
+texts = np.array([fake.paragraph()[:MAX_WARBLER_LENGTH]
+                  for _ in range(POOL_SIZE)])
+
+
+def pick(pool, size):
+    return pool[rng.integers(0, len(pool), size)]
+
+
+def write_csv(filename, headers, num_rows, make_columns):
+    """Write `num_rows` rows to `filename`, a chunk at a time.
+
+    make_columns(start, stop) returns the columns for rows [start, stop).
+    """
+
+    with open(os.path.join(args.out, filename), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(headers)
+
+        for start in range(0, num_rows, args.chunk_size):
+            stop = min(start + args.chunk_size, num_rows)
+            columns = [column.tolist()
+                       for column in make_columns(start, stop)]
+            writer.writerows(zip(*columns))
+
+    print(f"{filename}: {num_rows} rows")
+
+
+# usernames get the user's id appended, which keeps them (and emails) unique
+
+def user_columns(start, stop):
+    size = stop - start
+    usernames = np.char.add(pick(names, size),
+                            user_ids[start:stop].astype(str))
+
+    return [
+        np.char.add(usernames, pick(domains, size)),
+        usernames,
+        pick(np.array(image_urls), size),
+        np.full(size, PASSWORD),
+        pick(bios, size),
+        pick(np.array(header_image_urls), size),
+        pick(cities, size),
+    ]
+
+
+write_csv('users.csv', USERS_CSV_HEADERS, num_users, user_columns)
+
+
+num_messages = args.messages
+authors = rng.choice(user_ids, num_messages, p=activity)
+
+
+def message_columns(start, stop):
+    size = stop - start
+
+    return [
+        pick(texts, size),
+        random_timestamps(rng, size, args.end_date),
+        authors[start:stop],
+    ]
+
+
+write_csv('messages.csv', MESSAGES_CSV_HEADERS, num_messages, message_columns)
+
+
+num_follows = min(args.follows, num_users * (num_users - 1))
+followed, followers = unique_pairs(
+    rng, num_follows, num_users + 1,
+    lambda size: (rng.choice(user_ids, size, p=popularity),
+                  rng.choice(user_ids, size, p=activity)),
+    allow_equal=False)
+
+write_csv('follows.csv', FOLLOWS_CSV_HEADERS, num_follows,
+          lambda start, stop: [followed[start:stop], followers[start:stop]])
+
+
+# A liked message is picked in two steps, so no per-message weights are
+# needed: an author, weighted by popularity and how much they post, then one
+# of their messages.
+
+by_author = np.argsort(authors, kind='stable')
+posted = np.bincount(authors, minlength=num_users + 1)[1:]
+first_posted = np.cumsum(posted) - posted
+
+liked_authors = popularity * posted
+num_likes = min(args.likes, num_users * num_messages)
+
+
+def draw_likes(size):
+    author = rng.choice(num_users, size, p=liked_authors / liked_authors.sum())
+    position = first_posted[author] + (rng.random(size) * posted[author]).astype(np.int64)
+
+    return rng.choice(user_ids, size, p=activity), by_author[position] + 1
+
+
+if num_messages:
+    likers, liked = unique_pairs(rng, num_likes, num_messages + 1, draw_likes)
+
+    write_csv('likes.csv', LIKES_CSV_HEADERS, num_likes,
+              lambda start, stop: [likers[start:stop], liked[start:stop]])
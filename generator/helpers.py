@@ -1,14 +1,56 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import numpy as np
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def random_timestamps(rng, size, end, years=2):
+    """`size` random timestamp strings within the `years` years before `end`
+    (a 'YYYY-MM-DD' date), e.g. '2023-04-05 06:07:08.091011'."""
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    end = np.datetime64(end, 'us')
+    span = (end - (end - np.timedelta64(365 * years, 'D'))).astype(np.int64)
 
-    return datetime.fromtimestamp(random_timestamp)
+    stamps = end - rng.integers(0, span, size).astype('timedelta64[us]')
+
+    return np.char.replace(np.datetime_as_string(stamps, unit='us'), 'T', ' ')
+
+
+def power_law_weights(rng, n, exponent):
+    """Probabilities for n items following a power law: the k-th most popular
+    item is weighted 1 / k**exponent. Ranks are shuffled across items, so the
+    popular ones aren't just the lowest ids."""
+
+    weights = 1 / np.arange(1, n + 1) ** exponent
+    weights = weights[rng.permutation(n)]
+
+    return weights / weights.sum()
+
+
+def unique_pairs(rng, count, base, draw, allow_equal=True):
+    """`count` distinct (a, b) pairs, sorted, as two arrays.
+
+    Candidates come from `draw(size)`, which returns two arrays of values
+    below `base`; it is called until enough distinct pairs turn up. Memory
+    grows with `count`, not with the number of possible pairs.
+    """
+
+    keys = np.empty(0, dtype=np.int64)
+    rounds = 0
+
+    while len(keys) < count:
+        rounds += 1
+        if rounds > 100:
+            raise ValueError(f"Couldn't draw {count} distinct pairs; "
+                             f"try a smaller count or a flatter power law")
+
+        a, b = draw(int((count - len(keys)) * 1.25) + 100)
+        if not allow_equal:
+            distinct = a != b
+            a, b = a[distinct], b[distinct]
+
+        keys = np.unique(np.concatenate(
+            [keys, a.astype(np.int64) * base + b]))
+
+    keys = np.sort(rng.choice(keys, count, replace=False))
+
+    return keys // base, keys % base
@@ -0,0 +1,84 @@
+"""Conditional GET for Warbler's read routes.
+
+A route decorated with @conditional(validator) first asks `validator` for an
+ETag, which should come from a query or two on cheap version numbers (see
+User.version) rather than anything the page itself needs. When the request's
+If-None-Match already has that ETag the route answers 304 Not Modified
+without running the view or rendering its template; otherwise the page is
+rendered and sent with the ETag, to be revalidated next time.
+
+Every ETag also includes the app's BUILD_VERSION, so a deploy that changes
+the code or templates doesn't leave browsers revalidating the old pages.
+
+Pages for a session (logged in, or otherwise carrying a cookie) are marked
+private, so only the browser keeps them; anonymous pages may be stored by
+shared caches too. Either way the client must revalidate before each use.
+"""
+
+import os
+from functools import wraps
+from hashlib import sha1
+
+from flask import current_app, make_response, request, session
+
+
+def make_etag(*parts):
+    """An ETag from everything a page's content depends on."""
+
+    build = current_app.config.get('BUILD_VERSION')
+    return sha1(repr((build, parts)).encode()).hexdigest()
+
+
+def source_version(app):
+    """A hash of the app's modules and templates, as a BUILD_VERSION."""
+
+    paths = [os.path.join(app.root_path, name)
+             for name in os.listdir(app.root_path) if name.endswith('.py')]
+
+    templates = os.path.join(app.root_path, app.template_folder)
+    for root, dirs, files in os.walk(templates):
+        paths.extend(os.path.join(root, name) for name in files)
+
+    digest = sha1()
+    for path in sorted(paths):
+        digest.update(os.path.relpath(path, app.root_path).encode())
+        with open(path, 'rb') as source:
+            digest.update(source.read())
+
+    return digest.hexdigest()[:12]
+
+
+def conditional(validator):
+    """Decorate a GET view to support If-None-Match.
+
+    `validator` takes the view's arguments and returns the page's ETag, or
+    None to skip conditional handling (e.g. to let the view 404).
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            # a page about to show flashed messages is a one-off
+            if '_flashes' in session:
+                return view(**kwargs)
+
+            etag = validator(**kwargs)
+            if etag is None:
+                return view(**kwargs)
+
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(**kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = (
+                'private, no-cache' if session else 'public, no-cache')
+            response.vary.add('Cookie')
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,232 @@
+"""Bulk loader for Warbler's CSV datasets (see seed.py).
+
+Each CSV is streamed into its table in fixed-size chunks: through COPY on
+Postgres, or batched executemany INSERTs on other databases. Nothing holds a
+whole file in memory, and each chunk commits along with a progress record,
+so an interrupted load can be resumed where it stopped.
+
+Secondary indexes and the counter triggers are dropped/disabled for the
+load and rebuilt once at the end, which is much cheaper than maintaining
+them row by row. The stored counters and home timelines are computed in
+bulk just before that, so their writes skip the indexes too.
+"""
+
+import csv
+import io
+import os
+from datetime import datetime
+from itertools import islice
+from time import perf_counter
+
+from sqlalchemy import (Boolean, Column, Integer, MetaData, Table, Text,
+                        select, text)
+
+import migrations
+from models import db, User, TimelineEntry, USERNAME_TRGM_INDEX
+
+# tables to load, in foreign key order, and the CSV each is loaded from;
+# files that don't exist in the data directory are skipped
+TABLE_FILES = [
+    ('users', 'users.csv'),
+    ('messages', 'messages.csv'),
+    ('follows', 'follows.csv'),
+    ('likes', 'likes.csv'),
+]
+
+progress = Table(
+    'load_progress', MetaData(),
+    Column('table_name', Text, primary_key=True),
+    Column('rows_loaded', Integer, nullable=False),
+    Column('done', Boolean, nullable=False),
+)
+
+
+def load(data_dir='generator', chunk_size=10000, resume=False, log=print):
+    """Load the CSVs in `data_dir` into the database.
+
+    Unless resuming, the database is reset first. With `resume`, tables that
+    finished loading are skipped and a partly loaded table continues after
+    its last committed chunk.
+    """
+
+    engine = db.engine
+    postgres = engine.dialect.name == 'postgresql'
+
+    if not resume:
+        db.drop_all()
+        db.create_all()
+        progress.drop(engine, checkfirst=True)
+
+        if postgres:
+            migrations.stamp(engine)
+
+    progress.create(engine, checkfirst=True)
+
+    files = [(db.metadata.tables[name], os.path.join(data_dir, filename))
+             for name, filename in TABLE_FILES
+             if os.path.exists(os.path.join(data_dir, filename))]
+
+    with engine.connect() as conn:
+        with conn.begin():
+            drop_indexes(conn, postgres)
+
+        for table, path in files:
+            load_table(conn, table, path, chunk_size, postgres, log)
+
+        # while the indexes and triggers are still off, so the bulk writes
+        # don't maintain them row by row
+        log("Computing counters and timelines...")
+        User.reconcile_counters()
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        log("Building indexes...")
+        with conn.begin():
+            create_indexes(conn, postgres)
+
+    log("Done.")
+
+
+def load_table(conn, table, path, chunk_size, postgres, log):
+    """Stream one CSV into `table`, a chunk per transaction."""
+
+    (loaded, done) = load_progress(conn, table)
+
+    if done:
+        log(f"{table.name}: already loaded, skipping")
+        return
+
+    with open(path, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader)
+
+        # Rows get explicit ids (their line number) when the CSV has none,
+        # so other files can refer to them and a resumed load assigns the
+        # same ids as an uninterrupted one.
+        add_ids = 'id' in table.c and 'id' not in header
+        columns = ['id'] + header if add_ids else header
+
+        rows = islice(enumerate(reader, start=1), loaded, None)
+
+        start = perf_counter()
+        total = loaded
+
+        while True:
+            chunk = [[n] + row if add_ids else row
+                     for n, row in islice(rows, chunk_size)]
+            if not chunk:
+                break
+
+            with conn.begin():
+                if postgres:
+                    copy_rows(conn, table, columns, chunk)
+                else:
+                    insert_rows(conn, table, columns, chunk)
+
+                total += len(chunk)
+                save_progress(conn, table, total, False)
+
+            rate = (total - loaded) / (perf_counter() - start)
+            log(f"{table.name}: {total} rows ({rate:,.0f} rows/s)")
+
+    with conn.begin():
+        save_progress(conn, table, total, True)
+
+
+def copy_rows(conn, table, columns, rows):
+    """COPY `rows` into `table` (Postgres)."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    quote = conn.dialect.identifier_preparer.quote
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(
+        f"COPY {quote(table.name)} ({', '.join(map(quote, columns))}) "
+        f"FROM STDIN WITH (FORMAT csv)",
+        buffer)
+
+
+def insert_rows(conn, table, columns, rows):
+    """INSERT `rows` into `table` with one executemany."""
+
+    converters = [_converter(table.c[column]) for column in columns]
+
+    conn.execute(table.insert(), [
+        {column: convert(value)
+         for column, convert, value in zip(columns, converters, row)}
+        for row in rows
+    ])
+
+
+def drop_indexes(conn, postgres):
+    """Drop secondary indexes and, on Postgres, disable counter triggers."""
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            conn.execute(f"DROP INDEX IF EXISTS {index.name}")
+
+        if postgres:
+            conn.execute(f"ALTER TABLE {table.name} DISABLE TRIGGER USER")
+
+    if postgres:
+        conn.execute("DROP INDEX IF EXISTS ix_users_username_trgm")
+
+
+def create_indexes(conn, postgres):
+    """Rebuild everything drop_indexes() took away."""
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            conn.execute(f"DROP INDEX IF EXISTS {index.name}")
+            index.create(conn)
+
+        if postgres:
+            conn.execute(f"ALTER TABLE {table.name} ENABLE TRIGGER USER")
+
+    if postgres:
+        conn.execute(USERNAME_TRGM_INDEX)
+
+        # ids were loaded explicitly, so move the sequences past them
+        for table in db.metadata.sorted_tables:
+            if 'id' in table.c and table.c.id.autoincrement:
+                conn.execute(text(
+                    f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                    f"COALESCE(MAX(id), 0) + 1, false) FROM {table.name}"))
+
+
+def load_progress(conn, table):
+    """(rows committed so far, finished?) for `table`."""
+
+    row = conn.execute(
+        select([progress.c.rows_loaded, progress.c.done])
+        .where(progress.c.table_name == table.name)
+    ).fetchone()
+
+    return tuple(row) if row is not None else (0, False)
+
+
+def save_progress(conn, table, rows_loaded, done):
+    conn.execute(progress.delete().where(progress.c.table_name == table.name))
+    conn.execute(progress.insert().values(table_name=table.name,
+                                          rows_loaded=rows_loaded,
+                                          done=done))
+
+
+def _converter(column):
+    """CSV string -> value for `column`, with empty fields as NULL (as COPY
+    treats them)."""
+
+    python_type = column.type.python_type
+
+    def convert(value):
+        if value == '':
+            return None
+        if python_type is datetime:
+            return datetime.fromisoformat(value)
+        if python_type is bool:
+            return value.lower() in ('t', 'true', '1')
+        return python_type(value)
+
+    return convert
@@ -0,0 +1,185 @@
+"""Per-request latency and SQL metrics for Warbler, in Prometheus format.
+
+For every request, RequestMetrics records (by endpoint) the wall time, the
+time spent in SQL, the number of statements and the rows they returned, into
+histograms that /metrics exposes in the Prometheus text format. Other parts
+of the app can add their own gauges and counters with add_collector().
+
+Recording is a few perf_counter() calls and a locked increment per bucket,
+cheap enough to leave on. Streamed responses are timed up to the first byte.
+"""
+
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# name -> (help, buckets, which per-request value it observes)
+HISTOGRAMS = {
+    'warbler_request_seconds':
+        ("Request wall time.", SECONDS_BUCKETS, 'seconds'),
+    'warbler_request_db_seconds':
+        ("Time spent running SQL per request.", SECONDS_BUCKETS, 'db_seconds'),
+    'warbler_request_queries':
+        ("SQL statements per request.", COUNT_BUCKETS, 'queries'),
+    'warbler_request_rows':
+        ("Rows returned by SQL per request.", COUNT_BUCKETS, 'rows'),
+}
+
+
+class Histogram:
+    """Counts of observed values per bucket, plus their sum and count."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self._lock = Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        """(cumulative count per bucket incl. +Inf, sum, count)"""
+
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+
+        cumulative = []
+        running = 0
+        for n in counts:
+            running += n
+            cumulative.append(running)
+
+        return cumulative, total, count
+
+
+class RequestMetrics:
+    """Histograms of per-request measurements, labelled by endpoint."""
+
+    def __init__(self):
+        self._histograms = {}
+        self._requests = {}
+        self._collectors = []
+        self._lock = Lock()
+
+    def init_app(self, app):
+        """Time every request to `app`, and every statement on any engine.
+
+        Call before registering other request hooks, so their time counts.
+        """
+
+        app.before_request(self._start)
+        app.after_request(self._finish)
+
+        event.listen(Engine, 'before_cursor_execute', self._before_query)
+        event.listen(Engine, 'after_cursor_execute', self._after_query)
+
+    def add_collector(self, collect):
+        """Add metrics computed at scrape time.
+
+        collect() returns (name, type, help, value) tuples, type being
+        'gauge' or 'counter'. Can be used as a decorator.
+        """
+
+        self._collectors.append(collect)
+        return collect
+
+    def observe(self, endpoint, status, measured):
+        """Record one request's `measured` values (see HISTOGRAMS)."""
+
+        with self._lock:
+            key = (endpoint, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+
+            histograms = self._histograms.get(endpoint)
+            if histograms is None:
+                histograms = self._histograms[endpoint] = {
+                    name: Histogram(buckets)
+                    for name, (_, buckets, _) in HISTOGRAMS.items()
+                }
+
+        for name, (_, _, value) in HISTOGRAMS.items():
+            histograms[name].observe(measured[value])
+
+    def render(self):
+        """Everything, in the Prometheus text exposition format."""
+
+        lines = []
+
+        with self._lock:
+            requests = sorted(self._requests.items())
+            histograms = sorted(self._histograms.items())
+
+        lines += ["# HELP warbler_requests_total Requests handled.",
+                  "# TYPE warbler_requests_total counter"]
+        for (endpoint, status), count in requests:
+            lines.append(f'warbler_requests_total{{endpoint="{endpoint}",'
+                         f'status="{status}"}} {count}')
+
+        for name, (description, buckets, _) in HISTOGRAMS.items():
+            lines += [f"# HELP {name} {description}",
+                      f"# TYPE {name} histogram"]
+
+            for endpoint, by_name in histograms:
+                cumulative, total, count = by_name[name].snapshot()
+                label = f'endpoint="{endpoint}"'
+
+                for le, n in zip(buckets + ('+Inf',), cumulative):
+                    lines.append(f'{name}_bucket{{{label},le="{le}"}} {n}')
+                lines.append(f'{name}_sum{{{label}}} {total}')
+                lines.append(f'{name}_count{{{label}}} {count}')
+
+        for collect in self._collectors:
+            for name, kind, description, value in collect():
+                lines += [f"# HELP {name} {description}",
+                          f"# TYPE {name} {kind}",
+                          f"{name} {value}"]
+
+        return "\n".join(lines) + "\n"
+
+    def _start(self):
+        g._metrics = {'start': perf_counter(), 'db_seconds': 0.0,
+                      'queries': 0, 'rows': 0, 'query_starts': []}
+
+    def _finish(self, response):
+        measured = g.pop('_metrics', None)
+
+        if measured is not None:
+            measured['seconds'] = perf_counter() - measured['start']
+            self.observe(request.endpoint or 'unmatched',
+                         response.status_code, measured)
+
+        return response
+
+    def _before_query(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        measured = has_request_context() and g.get('_metrics')
+
+        if measured:
+            measured['query_starts'].append(perf_counter())
+
+    def _after_query(self, conn, cursor, statement, parameters, context,
+                     executemany):
+        measured = has_request_context() and g.get('_metrics')
+
+        if measured and measured['query_starts']:
+            start = measured['query_starts'].pop()
+            measured['db_seconds'] += perf_counter() - start
+            measured['queries'] += 1
+            measured['rows'] += max(cursor.rowcount, 0)
+
+
+request_metrics = RequestMetrics()
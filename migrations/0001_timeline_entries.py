@@ -0,0 +1,31 @@
+"""Materialized home timelines (TimelineEntry), filled from existing
+messages and follows."""
+
+
+def upgrade(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS timeline_entries (
+            user_id INTEGER NOT NULL
+                REFERENCES users (id) ON DELETE CASCADE,
+            message_id INTEGER NOT NULL
+                REFERENCES messages (id) ON DELETE CASCADE,
+            timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            PRIMARY KEY (user_id, message_id)
+        )
+    """)
+
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS ix_timeline_entries_user_timestamp
+            ON timeline_entries (user_id, timestamp, message_id)
+    """)
+
+    # every message goes on its author's timeline and their followers'
+    conn.execute("""
+        INSERT INTO timeline_entries (user_id, message_id, timestamp)
+        SELECT user_id, id, timestamp FROM messages
+        UNION
+        SELECT follows.user_following_id, messages.id, messages.timestamp
+          FROM messages
+          JOIN follows ON follows.user_being_followed_id = messages.user_id
+        ON CONFLICT DO NOTHING
+    """)
@@ -0,0 +1,99 @@
+"""Stored per-user counters (users.*_count) and the triggers maintaining
+them."""
+
+COUNTERS = ['messages_count', 'following_count', 'followers_count',
+            'likes_count']
+
+TRIGGERS = {
+    'follows': """
+        CREATE OR REPLACE FUNCTION count_follows() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE users SET followers_count = followers_count + 1
+                    WHERE id = NEW.user_being_followed_id;
+                UPDATE users SET following_count = following_count + 1
+                    WHERE id = NEW.user_following_id;
+                RETURN NEW;
+            END IF;
+            UPDATE users SET followers_count = followers_count - 1
+                WHERE id = OLD.user_being_followed_id;
+            UPDATE users SET following_count = following_count - 1
+                WHERE id = OLD.user_following_id;
+            RETURN OLD;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER follows_counters AFTER INSERT OR DELETE ON follows
+            FOR EACH ROW EXECUTE PROCEDURE count_follows();
+    """,
+    'likes': """
+        CREATE OR REPLACE FUNCTION count_likes() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE users SET likes_count = likes_count + 1
+                    WHERE id = NEW.user_id;
+                RETURN NEW;
+            END IF;
+            UPDATE users SET likes_count = likes_count - 1
+                WHERE id = OLD.user_id;
+            RETURN OLD;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER likes_counters AFTER INSERT OR DELETE ON likes
+            FOR EACH ROW EXECUTE PROCEDURE count_likes();
+    """,
+    'messages': """
+        CREATE OR REPLACE FUNCTION count_messages() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE users SET messages_count = messages_count + 1
+                    WHERE id = NEW.user_id;
+                RETURN NEW;
+            END IF;
+            UPDATE users SET messages_count = messages_count - 1
+                WHERE id = OLD.user_id;
+            RETURN OLD;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER messages_counters AFTER INSERT OR DELETE ON messages
+            FOR EACH ROW EXECUTE PROCEDURE count_messages();
+    """,
+}
+
+
+def upgrade(conn):
+    for counter in COUNTERS:
+        conn.execute(f"""
+            ALTER TABLE users
+                ADD COLUMN IF NOT EXISTS {counter} INTEGER NOT NULL DEFAULT 0
+        """)
+
+    for table, ddl in TRIGGERS.items():
+        conn.execute(f"DROP TRIGGER IF EXISTS {table}_counters ON {table}")
+        conn.execute(ddl)
+
+    # catch up on the rows that existed before the triggers; the triggers
+    # see everything from here on, as this runs in the same transaction
+    conn.execute("""
+        UPDATE users SET
+            messages_count = COALESCE(messages.n, 0),
+            following_count = COALESCE(following.n, 0),
+            followers_count = COALESCE(followers.n, 0),
+            likes_count = COALESCE(likes.n, 0)
+        FROM users AS counted
+        LEFT JOIN (SELECT user_id AS owner, count(*) AS n
+                     FROM messages GROUP BY user_id) AS messages
+               ON messages.owner = counted.id
+        LEFT JOIN (SELECT user_following_id AS owner, count(*) AS n
+                     FROM follows GROUP BY user_following_id) AS following
+               ON following.owner = counted.id
+        LEFT JOIN (SELECT user_being_followed_id AS owner, count(*) AS n
+                     FROM follows GROUP BY user_being_followed_id) AS followers
+               ON followers.owner = counted.id
+        LEFT JOIN (SELECT user_id AS owner, count(*) AS n
+                     FROM likes GROUP BY user_id) AS likes
+               ON likes.owner = counted.id
+        WHERE users.id = counted.id
+    """)
@@ -0,0 +1,19 @@
+"""Trigram index for substring username search, where pg_trgm is
+available."""
+
+
+def upgrade(conn):
+    conn.execute("""
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM pg_available_extensions
+                       WHERE name = 'pg_trgm') THEN
+                CREATE EXTENSION IF NOT EXISTS pg_trgm;
+                CREATE INDEX IF NOT EXISTS ix_users_username_trgm
+                    ON users USING gin (username gin_trgm_ops);
+            END IF;
+        EXCEPTION WHEN insufficient_privilege THEN
+            RAISE NOTICE 'pg_trgm not installed; username search unindexed';
+        END
+        $$;
+    """)
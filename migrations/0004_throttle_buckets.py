@@ -0,0 +1,12 @@
+"""Shared token buckets for the database login throttle backend."""
+
+
+def upgrade(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS throttle_buckets (
+            key TEXT PRIMARY KEY,
+            tokens FLOAT NOT NULL,
+            allowed BOOLEAN NOT NULL,
+            updated_at TIMESTAMP WITHOUT TIME ZONE NOT NULL
+        )
+    """)
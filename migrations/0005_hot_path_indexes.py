@@ -0,0 +1,37 @@
+"""Composite indexes for the profile, following and likes queries, and
+likes made unique per (user, message) instead of per message.
+
+(Indexes are built inside the migration's transaction, which locks the
+table against writes while they build; on a large live database, create
+them CONCURRENTLY by hand first and this will skip them.)
+"""
+
+
+def upgrade(conn):
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS ix_messages_user_id_timestamp
+            ON messages (user_id, timestamp, id)
+    """)
+
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS ix_follows_user_following_id
+            ON follows (user_following_id, user_being_followed_id)
+    """)
+
+    # the old constraint only let one user like each message
+    conn.execute("ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_key")
+
+    conn.execute("""
+        DO $$
+        BEGIN
+            ALTER TABLE likes ADD CONSTRAINT uq_likes_user_id_message_id
+                UNIQUE (user_id, message_id);
+        EXCEPTION WHEN duplicate_table OR duplicate_object THEN
+            NULL;
+        END
+        $$
+    """)
+
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS ix_likes_message_id ON likes (message_id)
+    """)
@@ -0,0 +1,26 @@
+"""users.version, bumped on every change to a user row, for HTTP
+validators."""
+
+
+def upgrade(conn):
+    conn.execute("CREATE SEQUENCE IF NOT EXISTS users_version_seq")
+
+    # the default is evaluated per row, so existing users get distinct
+    # versions too
+    conn.execute("""
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL
+            DEFAULT nextval('users_version_seq')
+    """)
+
+    conn.execute("DROP TRIGGER IF EXISTS users_version ON users")
+    conn.execute("""
+        CREATE OR REPLACE FUNCTION bump_user_version() RETURNS trigger AS $$
+        BEGIN
+            NEW.version := nextval('users_version_seq');
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER users_version BEFORE UPDATE ON users
+            FOR EACH ROW EXECUTE PROCEDURE bump_user_version();
+    """)
@@ -0,0 +1,13 @@
+"""Shared anonymous pages for the database page cache backend."""
+
+
+def upgrade(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS page_cache (
+            key TEXT PRIMARY KEY,
+            stored_at FLOAT NOT NULL,
+            status INTEGER NOT NULL,
+            headers TEXT NOT NULL,
+            body BYTEA NOT NULL
+        )
+    """)
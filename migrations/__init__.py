@@ -0,0 +1,80 @@
+"""Versioned schema migrations for Warbler (Postgres).
+
+Each NNNN_description.py module in this package is one migration, with an
+upgrade(conn) function; they run in version order, each in its own
+transaction, and applied versions are recorded in schema_migrations.
+
+    flask migrate           # apply pending migrations
+    flask migrate --stamp   # record every migration as applied
+
+New databases get the current schema straight from the models
+(db.create_all(), as seed.py does) and are stamped; existing databases are
+brought up to date with `flask migrate`. Migrations only add what is
+missing (IF NOT EXISTS and friends), so they are safe to run against a
+database that already has part of a change.
+
+A migration spells out the DDL it applies rather than importing it from
+models, so later changes to the models don't change what old migrations do.
+"""
+
+import pkgutil
+from datetime import datetime
+from importlib import import_module
+
+from sqlalchemy import Column, DateTime, MetaData, Table, Text, select
+
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('version', Text, primary_key=True),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+def available():
+    """Names of all migrations, in the order they apply."""
+
+    return sorted(module.name for module in pkgutil.iter_modules(__path__)
+                  if module.name[:4].isdigit())
+
+
+def applied(conn):
+    """Names of the migrations already applied to `conn`'s database."""
+
+    schema_migrations.create(conn, checkfirst=True)
+    return {version for (version,)
+            in conn.execute(select([schema_migrations.c.version]))}
+
+
+def upgrade(engine, log=print):
+    """Apply every pending migration; returns their names."""
+
+    with engine.begin() as conn:
+        done = applied(conn)
+
+    pending = [version for version in available() if version not in done]
+
+    for version in pending:
+        log(f"Applying {version}...")
+
+        with engine.begin() as conn:
+            import_module(f'{__name__}.{version}').upgrade(conn)
+            _record(conn, version)
+
+    return pending
+
+
+def stamp(engine):
+    """Record every migration as applied, for a database created from the
+    current models."""
+
+    with engine.begin() as conn:
+        done = applied(conn)
+
+        for version in available():
+            if version not in done:
+                _record(conn, version)
+
+
+def _record(conn, version):
+    conn.execute(schema_migrations.insert().values(
+        version=version, applied_at=datetime.utcnow()))
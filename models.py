@@ -2,11 +2,12 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, case, event, func, literal, select, text, union
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import password_hasher
+from routing import RoutingSQLAlchemy
+
+db = RoutingSQLAlchemy()
 
 
 class Follows(db.Model):
@@ -26,6 +27,57 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # the primary key serves "who follows X"; this serves "who does X follow"
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 user_following_id, user_being_followed_id),
+    )
+
+    # Follows every existing user in :followed_ids (except the follower),
+    # skipping those already followed; returns the ids newly followed
+    FOLLOW = text("""
+        INSERT INTO follows (user_being_followed_id, user_following_id)
+        SELECT id, :user_id FROM users
+         WHERE id = ANY(:followed_ids) AND id <> :user_id
+        ON CONFLICT DO NOTHING
+        RETURNING user_being_followed_id
+    """)
+
+    UNFOLLOW = text("""
+        DELETE FROM follows
+         WHERE user_following_id = :user_id
+           AND user_being_followed_id = :followed_id
+        RETURNING user_being_followed_id
+    """)
+
+    @classmethod
+    def follow(cls, user_id, followed_ids):
+        """Have `user_id` follow each of `followed_ids`, in one statement
+        however many there are. Ids that don't exist or are already followed
+        are skipped.
+
+        Returns the set of ids newly followed.
+        """
+
+        followed_ids = list(followed_ids)
+        if not followed_ids:
+            return set()
+
+        followed = db.session.execute(
+            cls.FOLLOW, {'user_id': user_id, 'followed_ids': followed_ids})
+
+        return {followed_id for (followed_id,) in followed}
+
+    @classmethod
+    def unfollow(cls, user_id, followed_id):
+        """Have `user_id` stop following `followed_id`; returns whether they
+        were following them."""
+
+        unfollowed = db.session.execute(
+            cls.UNFOLLOW, {'user_id': user_id, 'followed_id': followed_id})
+
+        return unfollowed.fetchone() is not None
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -45,9 +97,56 @@ class Likes(db.Model):
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
     )
 
+    # one like per user per message; the unique index also serves a user's
+    # likes, and the second index a message's
+    __table_args__ = (
+        db.UniqueConstraint(user_id, message_id,
+                            name='uq_likes_user_id_message_id'),
+        db.Index('ix_likes_message_id', message_id),
+    )
+
+    # Likes or unlikes in one statement: delete the like if there is one,
+    # otherwise insert it. Returns whether the message is now liked and its
+    # like count after the change (the CTEs' changes aren't visible to the
+    # count, so they are added in).
+    TOGGLE = text("""
+        WITH deleted AS (
+            DELETE FROM likes
+             WHERE user_id = :user_id AND message_id = :message_id
+            RETURNING id
+        ), inserted AS (
+            INSERT INTO likes (user_id, message_id)
+            SELECT :user_id, :message_id
+             WHERE NOT EXISTS (SELECT 1 FROM deleted)
+            ON CONFLICT (user_id, message_id) DO NOTHING
+            RETURNING id
+        )
+        SELECT NOT EXISTS (SELECT 1 FROM deleted) AS liked,
+               (SELECT count(*) FROM likes WHERE message_id = :message_id)
+               + (SELECT count(*) FROM inserted)
+               - (SELECT count(*) FROM deleted) AS likes
+    """)
+
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like `message_id` for `user_id`, or unlike it if already liked.
+
+        Returns (liked, like count). Raises IntegrityError if there's no such
+        message.
+        """
+
+        liked, likes = db.session.execute(
+            cls.TOGGLE, {'user_id': user_id, 'message_id': message_id}
+        ).fetchone()
+
+        return liked, likes
+
+
+# source of User.version values
+user_versions = db.Sequence('users_version_seq', metadata=db.Model.metadata)
+
 
 class User(db.Model):
     """User in the system."""
@@ -94,6 +193,49 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counts of the relationships below, so pages can show them
+    # without loading the collections. Kept in step by database triggers
+    # (see COUNTER_TRIGGERS); User.reconcile_counters() recomputes them.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # On Postgres, set from users_version_seq on insert and again by a
+    # trigger on every update (USER_VERSION_TRIGGER), counter updates
+    # included, so it moves whenever anything shown about the user does.
+    # Values only ever grow, across all users, which makes them usable as
+    # HTTP validators. Other databases leave it at 0.
+    version = db.Column(
+        db.BigInteger,
+        nullable=False,
+        server_default='0',
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -121,14 +263,139 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return self.id in other_user.following_ids_among([self.id])
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.following_ids_among([other_user.id])
+
+    def following_ids_among(self, user_ids):
+        """Which of `user_ids` is this user following?
+
+        Returns a set built from a single indexed query, so a page showing
+        many users can check follow state for each with a set lookup instead
+        of loading this user's whole following list.
+        """
+
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+
+        followed = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == self.id,
+                            Follows.user_being_followed_id.in_(user_ids)))
+
+        return {user_id for (user_id,) in followed}
+
+    @classmethod
+    def by_id(cls, user_ids):
+        """{id: user} for those of `user_ids` that exist, in one query.
+
+        The rows replace any copies already in the session (e.g. a cached
+        g.user) and stay there, so later lookups of them in the same
+        request (query.get, g.user) reuse these rows rather than loading
+        newer ones.
+        """
+
+        user_ids = [user_id for user_id in user_ids if user_id is not None]
+        if not user_ids:
+            return {}
+
+        users = cls.query.populate_existing().filter(cls.id.in_(user_ids))
+        return {user.id: user for user in users}
+
+    def liked_ids_among(self, message_ids):
+        """Which of `message_ids` has this user liked?
+
+        Like following_ids_among: one query for a whole page of messages,
+        returned as a set for the templates to test membership against.
+        """
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return set()
+
+        liked = (db.session
+                 .query(Likes.message_id)
+                 .filter(Likes.user_id == self.id,
+                         Likes.message_id.in_(message_ids)))
+
+        return {message_id for (message_id,) in liked}
+
+    @classmethod
+    def search(cls, term):
+        """Query for users whose username contains `term`, ignoring case
+        (as autocomplete does), best match first.
+
+        Exact matches rank first, then usernames starting with `term`, then
+        the rest; shorter usernames win within each group. On Postgres the
+        ILIKE is served by the trigram index (see USERNAME_TRGM_INDEX).
+        """
+
+        pattern = (term.replace('\\', '\\\\')
+                   .replace('%', '\\%')
+                   .replace('_', '\\_'))
+
+        rank = case(
+            [(cls.username.ilike(pattern, escape='\\'), 0),
+             (cls.username.ilike(f"{pattern}%", escape='\\'), 1)],
+            else_=2,
+        )
+
+        return (cls.query
+                .filter(cls.username.ilike(f"%{pattern}%", escape='\\'))
+                .order_by(rank, func.length(cls.username), cls.username))
+
+    @classmethod
+    def reconcile_counters(cls):
+        """Recompute every user's stored counters from the underlying tables.
+
+        Use after loading data with the triggers disabled, or to repair
+        drift. It is a single bulk UPDATE. On Postgres it joins each user to
+        their counts grouped once per table (rather than a subquery per
+        user, which would scan follows and likes once per user); other
+        databases, which can't UPDATE ... FROM, get the subqueries.
+        """
+
+        counters = (('messages_count', Message.user_id),
+                    ('following_count', Follows.user_following_id),
+                    ('followers_count', Follows.user_being_followed_id),
+                    ('likes_count', Likes.user_id))
+
+        if db.session.get_bind().dialect.name != 'postgresql':
+            db.session.execute(cls.__table__.update().values({
+                counter: (select([func.count()])
+                          .where(owner == cls.id)
+                          .as_scalar())
+                for counter, owner in counters
+            }))
+            return
+
+        def grouped(column):
+            return (select([column.label('owner'),
+                            func.count().label('n')])
+                    .group_by(column)
+                    .alias())
+
+        users = cls.__table__.alias()
+        joined = users
+        counts = []
+
+        for counter, owner in counters:
+            counted = grouped(owner)
+            joined = joined.outerjoin(counted, counted.c.owner == users.c.id)
+            counts.append(func.coalesce(counted.c.n, 0).label(counter))
+
+        totals = (select([users.c.id] + counts)
+                  .select_from(joined)
+                  .alias())
+
+        db.session.execute(cls.__table__.update()
+                           .where(cls.id == totals.c.id)
+                           .values({count.name: totals.c[count.name]
+                                    for count in counts}))
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -137,7 +404,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_hasher.hash(password)
 
         user = User(
             username=username,
@@ -158,14 +425,19 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        A password hashed with an outdated work factor is rehashed with the
+        current one; the caller commits it.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
             try:
-                is_auth = bcrypt.check_password_hash(user.password, password)
+                is_auth = password_hasher.check(user.password, password)
                 if is_auth:
+                    if password_hasher.needs_rehash(user.password):
+                        user.password = password_hasher.hash(password)
                     return user
             except ValueError:
                 return False
@@ -190,7 +462,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -201,6 +473,414 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    # serves a profile's messages newest first, a page at a time
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', user_id, timestamp, id),
+    )
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into one user's home timeline.
+
+    Entries are written when a message is posted (fan-out-on-write), so the
+    homepage reads a precomputed, ordered list of message ids instead of
+    gathering messages from everyone the user follows on every request.
+
+    A timeline keeps its newest MAX_LENGTH entries. Following someone
+    prunes the follower's timeline straight away; timelines that grow from
+    posts are pruned in batches off the request path (`flask
+    prune-timelines`, run periodically), so posting costs one insert
+    however many followers there are.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # copy of the message's timestamp, so a timeline can be read in order
+    # straight off the index below
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_timestamp',
+                 user_id, timestamp, message_id),
+    )
+
+    COLUMNS = ['user_id', 'message_id', 'timestamp']
+
+    # entries kept per timeline
+    MAX_LENGTH = 800
+
+    # messages copied into a timeline from each newly followed user
+    BACKFILL_PER_AUTHOR = 100
+
+    # Copies the newest :per_author messages of each of :followed_ids into
+    # :user_id's timeline, skipping those already there
+    BACKFILL = text("""
+        INSERT INTO timeline_entries (user_id, message_id, timestamp)
+        SELECT :user_id, recent.id, recent.timestamp
+          FROM unnest(CAST(:followed_ids AS integer[])) AS author (id)
+         CROSS JOIN LATERAL (
+                SELECT id, timestamp FROM messages
+                 WHERE user_id = author.id
+                 ORDER BY timestamp DESC, id DESC
+                 LIMIT :per_author) AS recent
+        ON CONFLICT DO NOTHING
+    """)
+
+    # Deletes all but the newest :keep entries of each of :user_ids'
+    # timelines; each one costs a walk of :keep index entries
+    PRUNE = text("""
+        DELETE FROM timeline_entries AS entry
+         USING unnest(CAST(:user_ids AS integer[])) AS owner (id)
+         CROSS JOIN LATERAL (
+                SELECT timestamp, message_id FROM timeline_entries
+                 WHERE user_id = owner.id
+                 ORDER BY timestamp DESC, message_id DESC
+                 OFFSET :keep LIMIT 1) AS newest_pruned
+         WHERE entry.user_id = owner.id
+           AND (entry.timestamp, entry.message_id)
+               <= (newest_pruned.timestamp, newest_pruned.message_id)
+    """)
+
+    @classmethod
+    def fan_out(cls, message):
+        """Add a newly posted `message` to its author's and followers' timelines.
+
+        `message` must already be flushed, so it has an id and timestamp.
+        """
+
+        author = select([
+            literal(message.user_id),
+            literal(message.id),
+            literal(message.timestamp),
+        ])
+        followers = (select([
+            Follows.user_following_id,
+            literal(message.id),
+            literal(message.timestamp),
+        ]).where(Follows.user_being_followed_id == message.user_id))
+
+        db.session.execute(cls.__table__.insert().from_select(
+            cls.COLUMNS, union(author, followers)))
+
+    @classmethod
+    def prune(cls, user_ids):
+        """Cut each of `user_ids`' timelines back to MAX_LENGTH entries."""
+
+        user_ids = list(user_ids)
+        if user_ids:
+            db.session.execute(cls.PRUNE,
+                               {'user_ids': user_ids, 'keep': cls.MAX_LENGTH})
+
+    @classmethod
+    def prune_all(cls, batch_size=1000):
+        """Cut every timeline back to MAX_LENGTH entries, committing after
+        each `batch_size` users so no transaction holds many rows locked.
+
+        Returns how many entries were deleted.
+        """
+
+        deleted = 0
+        last_id = 0
+
+        while True:
+            user_ids = [user_id for (user_id,) in
+                        db.session.query(User.id)
+                        .filter(User.id > last_id)
+                        .order_by(User.id)
+                        .limit(batch_size)]
+            if not user_ids:
+                return deleted
+
+            deleted += db.session.execute(cls.PRUNE, {
+                'user_ids': user_ids,
+                'keep': cls.MAX_LENGTH,
+            }).rowcount
+            db.session.commit()
+            last_id = user_ids[-1]
+
+    @classmethod
+    def remove_message(cls, message_id):
+        """Remove a message from every timeline it was fanned out to."""
+
+        (cls.query
+         .filter(cls.message_id == message_id)
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def add_authors(cls, user_id, followed_ids):
+        """Backfill the newest BACKFILL_PER_AUTHOR messages of every user in
+        `followed_ids` into `user_id`'s timeline, in one statement, then
+        prune it back to MAX_LENGTH."""
+
+        followed_ids = list(followed_ids)
+        if not followed_ids:
+            return
+
+        db.session.execute(cls.BACKFILL, {
+            'user_id': user_id,
+            'followed_ids': followed_ids,
+            'per_author': cls.BACKFILL_PER_AUTHOR,
+        })
+        cls.prune([user_id])
+
+    @classmethod
+    def remove_author(cls, user_id, followed_id):
+        """Drop `followed_id`'s messages from `user_id`'s timeline."""
+
+        # users always see their own messages
+        if user_id == followed_id:
+            return
+
+        authored = select([Message.id]).where(Message.user_id == followed_id)
+        (cls.query
+         .filter(cls.user_id == user_id, cls.message_id.in_(authored))
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute every timeline from the messages and follows tables.
+
+        Used to backfill timelines for data that was loaded without going
+        through the app (e.g. seed.py) or to repair drift. Each timeline
+        gets its newest MAX_LENGTH entries.
+        """
+
+        cls.query.delete(synchronize_session=False)
+
+        own = select([
+            Message.user_id.label('user_id'),
+            Message.id.label('message_id'),
+            Message.timestamp.label('timestamp'),
+        ])
+        followed = (select([
+            Follows.user_following_id,
+            Message.id,
+            Message.timestamp,
+        ]).where(Follows.user_being_followed_id == Message.user_id))
+
+        entries = union(own, followed).alias()
+        ranked = select([
+            entries.c.user_id,
+            entries.c.message_id,
+            entries.c.timestamp,
+            func.row_number().over(
+                partition_by=entries.c.user_id,
+                order_by=(entries.c.timestamp.desc(),
+                          entries.c.message_id.desc()),
+            ).label('position'),
+        ]).alias()
+
+        newest = (select([ranked.c.user_id, ranked.c.message_id,
+                          ranked.c.timestamp])
+                  .where(ranked.c.position <= cls.MAX_LENGTH))
+
+        db.session.execute(cls.__table__.insert().from_select(
+            cls.COLUMNS, newest))
+
+
+class ThrottleBucket(db.Model):
+    """Token bucket shared by all workers for the login throttle.
+
+    Only used with LOGIN_THROTTLE_BACKEND = 'database'; see throttle.py.
+    """
+
+    __tablename__ = 'throttle_buckets'
+
+    key = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    tokens = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    # whether the last attempt got a token
+    allowed = db.Column(
+        db.Boolean,
+        nullable=False,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+class CachedPage(db.Model):
+    """Rendered anonymous page shared by all workers.
+
+    Only used with PAGE_CACHE_BACKEND = 'database'; see pagecache.py.
+    """
+
+    __tablename__ = 'page_cache'
+
+    # path and query string
+    key = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    # time.time() when rendered
+    stored_at = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    status = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # JSON list of [name, value] pairs
+    headers = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    body = db.Column(
+        db.LargeBinary,
+        nullable=False,
+    )
+
+
+# Triggers keeping the users.*_count columns in step with the rows they
+# count. Living in the database, they also cover relationship appends, bulk
+# loads and ON DELETE CASCADE deletes, which never pass through the routes.
+
+COUNTER_TRIGGERS = {
+    'follows': """
+        CREATE OR REPLACE FUNCTION count_follows() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE users SET followers_count = followers_count + 1
+                    WHERE id = NEW.user_being_followed_id;
+                UPDATE users SET following_count = following_count + 1
+                    WHERE id = NEW.user_following_id;
+                RETURN NEW;
+            END IF;
+            UPDATE users SET followers_count = followers_count - 1
+                WHERE id = OLD.user_being_followed_id;
+            UPDATE users SET following_count = following_count - 1
+                WHERE id = OLD.user_following_id;
+            RETURN OLD;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER follows_counters AFTER INSERT OR DELETE ON follows
+            FOR EACH ROW EXECUTE PROCEDURE count_follows();
+    """,
+    'likes': """
+        CREATE OR REPLACE FUNCTION count_likes() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE users SET likes_count = likes_count + 1
+                    WHERE id = NEW.user_id;
+                RETURN NEW;
+            END IF;
+            UPDATE users SET likes_count = likes_count - 1
+                WHERE id = OLD.user_id;
+            RETURN OLD;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER likes_counters AFTER INSERT OR DELETE ON likes
+            FOR EACH ROW EXECUTE PROCEDURE count_likes();
+    """,
+    'messages': """
+        CREATE OR REPLACE FUNCTION count_messages() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE users SET messages_count = messages_count + 1
+                    WHERE id = NEW.user_id;
+                RETURN NEW;
+            END IF;
+            UPDATE users SET messages_count = messages_count - 1
+                WHERE id = OLD.user_id;
+            RETURN OLD;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER messages_counters AFTER INSERT OR DELETE ON messages
+            FOR EACH ROW EXECUTE PROCEDURE count_messages();
+    """,
+}
+
+for table_name, ddl in COUNTER_TRIGGERS.items():
+    event.listen(
+        db.Model.metadata.tables[table_name],
+        'after_create',
+        DDL(ddl).execute_if(dialect='postgresql'),
+    )
+
+
+# Gives a user row a new version on insert and on every update (see
+# User.version).
+
+USER_VERSION_TRIGGER = """
+    ALTER TABLE users
+        ALTER COLUMN version SET DEFAULT nextval('users_version_seq');
+
+    CREATE OR REPLACE FUNCTION bump_user_version() RETURNS trigger AS $$
+    BEGIN
+        NEW.version := nextval('users_version_seq');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER users_version BEFORE UPDATE ON users
+        FOR EACH ROW EXECUTE PROCEDURE bump_user_version();
+"""
+
+event.listen(
+    User.__table__,
+    'after_create',
+    DDL(USER_VERSION_TRIGGER).execute_if(dialect='postgresql'),
+)
+
+
+# Trigram index so substring searches on usernames (User.search) don't scan
+# the whole table. pg_trgm is a contrib extension, so only build the index
+# where it is available and we are allowed to install it; searches still
+# work without it, just slower.
+
+USERNAME_TRGM_INDEX = """
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM pg_available_extensions
+                   WHERE name = 'pg_trgm') THEN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            CREATE INDEX IF NOT EXISTS ix_users_username_trgm
+                ON users USING gin (username gin_trgm_ops);
+        END IF;
+    EXCEPTION WHEN insufficient_privilege THEN
+        RAISE NOTICE 'pg_trgm not installed; username search unindexed';
+    END
+    $$;
+"""
+
+event.listen(
+    User.__table__,
+    'after_create',
+    DDL(USERNAME_TRGM_INDEX).execute_if(dialect='postgresql'),
+)
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -0,0 +1,258 @@
+"""Full-page cache for anonymous visitors to Warbler.
+
+Logged-out visitors all see the same home page, profiles and messages, so
+when PAGE_CACHE is on those pages are rendered once and replayed to every
+anonymous request for the same path and query string. The lookup runs as a
+before_request hook ahead of add_user_to_g, so a hit returns without
+loading a user or touching the database (with the memory backend).
+
+A page is fresh for PAGE_CACHE_TTL seconds. For PAGE_CACHE_STALE seconds
+after that it is still served, while one background request renders it
+again (stale-while-revalidate); after that it is rendered on the request.
+
+Pages live in a backend: MemoryBackend is a per-process LRU; with several
+workers DatabaseBackend shares them through Postgres, at the cost of one
+primary key lookup per request.
+"""
+
+import json
+from collections import OrderedDict
+from threading import Lock, Thread
+from time import time
+
+from flask import g, request, session
+from sqlalchemy import text
+
+# set on the background requests that re-render stale pages
+REFRESH = 'warbler.page_cache_refresh'
+
+# how many pages DatabaseBackend stores between deleting expired ones
+PRUNE_EVERY = 100
+
+
+class MemoryBackend:
+    """Pages in a per-process LRU dict."""
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._pages = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """(stored_at, status, headers, body) for `key`, or None."""
+
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+            return page
+
+    def set(self, key, page, max_age):
+        with self._lock:
+            self._pages[key] = page
+            self._pages.move_to_end(key)
+
+            while len(self._pages) > self.maxsize:
+                self._pages.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+
+class DatabaseBackend:
+    """Pages in the page_cache table, shared by all workers.
+
+    Each get() and set() runs in its own transaction. Expired pages are
+    deleted every PRUNE_EVERY stores. Postgres only.
+    """
+
+    GET = text("""
+        SELECT stored_at, status, headers, body FROM page_cache
+         WHERE key = :key
+    """)
+
+    SET = text("""
+        INSERT INTO page_cache (key, stored_at, status, headers, body)
+        VALUES (:key, :stored_at, :status, :headers, :body)
+        ON CONFLICT (key) DO UPDATE SET
+            stored_at = excluded.stored_at,
+            status = excluded.status,
+            headers = excluded.headers,
+            body = excluded.body
+    """)
+
+    PRUNE = text("DELETE FROM page_cache WHERE stored_at < :before")
+
+    def __init__(self, db):
+        self.db = db
+        self._stores = 0
+
+    def get(self, key):
+        with self.db.engine.begin() as conn:
+            row = conn.execute(self.GET, key=key).fetchone()
+
+        if row is None:
+            return None
+
+        stored_at, status, headers, body = row
+        return (stored_at, status, [tuple(header)
+                                    for header in json.loads(headers)],
+                bytes(body))
+
+    def set(self, key, page, max_age):
+        stored_at, status, headers, body = page
+
+        with self.db.engine.begin() as conn:
+            conn.execute(self.SET, key=key, stored_at=stored_at,
+                         status=status, headers=json.dumps(headers),
+                         body=body)
+
+            self._stores += 1
+            if self._stores % PRUNE_EVERY == 0:
+                conn.execute(self.PRUNE, before=time() - max_age)
+
+    def clear(self):
+        with self.db.engine.begin() as conn:
+            conn.execute(text("DELETE FROM page_cache"))
+
+
+class PageCache:
+    """Caches the pages of `endpoints` for requests without a user."""
+
+    def __init__(self, backend=None):
+        self.app = None
+        self.backend = backend or MemoryBackend()
+        self.enabled = False
+        self.endpoints = set()
+        self.ttl = 10
+        self.stale = 60
+        self.user_key = None
+
+        self._lock = Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+        self._refreshing = {}
+
+    def init_app(self, app, db, user_key):
+        """Configure from the PAGE_CACHE_* settings. `user_key` is the
+        session key holding the logged-in user.
+
+        Call before registering the hook that loads the user, so hits skip
+        it.
+        """
+
+        self.app = app
+
+        if app.config['PAGE_CACHE_BACKEND'] == 'database':
+            self.backend = DatabaseBackend(db)
+        else:
+            self.backend = MemoryBackend(app.config['PAGE_CACHE_SIZE'])
+
+        self.enabled = app.config['PAGE_CACHE']
+        self.endpoints = set(app.config['PAGE_CACHE_ENDPOINTS'])
+        self.ttl = app.config['PAGE_CACHE_TTL']
+        self.stale = app.config['PAGE_CACHE_STALE']
+        self.user_key = user_key
+
+        app.before_request(self._serve)
+        app.after_request(self._store)
+
+    def stats(self):
+        """How many anonymous page requests were served fresh from the
+        cache, served stale while refreshed, and rendered."""
+
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+            }
+
+    def wait(self):
+        """Wait for background refreshes to finish."""
+
+        for thread in list(self._refreshing.values()):
+            thread.join()
+
+    def _cacheable(self):
+        return (self.enabled
+                and request.method == 'GET'
+                and request.endpoint in self.endpoints
+                and self.user_key not in session
+                and '_flashes' not in session)
+
+    def _serve(self):
+        if not self._cacheable():
+            return None
+
+        key = request.full_path
+        g._page_cache_key = key
+
+        if request.environ.get(REFRESH):
+            return None
+
+        page = self.backend.get(key)
+        age = time() - page[0] if page is not None else None
+
+        if age is None or age > self.ttl + self.stale:
+            self._count('misses')
+            return None
+
+        if age > self.ttl:
+            self._count('stale_hits')
+            self._refresh(key)
+        else:
+            self._count('hits')
+
+        g.pop('_page_cache_key')
+
+        stored_at, status, headers, body = page
+        response = self.app.response_class(body, status=status,
+                                           headers=headers)
+        response.headers['Age'] = str(int(age))
+        return response.make_conditional(request)
+
+    def _store(self, response):
+        key = g.pop('_page_cache_key', None)
+
+        if (key is None or response.status_code != 200
+                or response.direct_passthrough or response.is_streamed
+                or session.modified or self.user_key in session):
+            return response
+
+        headers = [(name, value) for name, value in response.headers
+                   if name.lower() not in ('set-cookie', 'content-length')]
+        self.backend.set(key,
+                         (time(), 200, headers, response.get_data()),
+                         self.ttl + self.stale)
+
+        return response
+
+    def _refresh(self, key):
+        """Render `key` again in the background, unless that's under way."""
+
+        with self._lock:
+            if key in self._refreshing:
+                return
+
+            thread = Thread(target=self._render, args=(key,), daemon=True)
+            self._refreshing[key] = thread
+
+        thread.start()
+
+    def _render(self, key):
+        try:
+            self.app.test_client().get(key, environ_base={REFRESH: True})
+        finally:
+            with self._lock:
+                self._refreshing.pop(key, None)
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+page_cache = PageCache()
@@ -0,0 +1,60 @@
+"""Keyset (cursor) pagination for Warbler's message lists.
+
+Pages are selected with a row comparison against the last row of the
+previous page, `(timestamp, id) < (cursor timestamp, cursor id)`, rather than
+an OFFSET, so every page costs one index range scan no matter how deep it is.
+"""
+
+from datetime import datetime
+
+from flask import abort
+from sqlalchemy import tuple_
+
+CURSOR_TIMESTAMP_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def encode_cursor(timestamp, id):
+    """Make a URL-safe cursor pointing just past (`timestamp`, `id`)."""
+
+    return f"{timestamp.strftime(CURSOR_TIMESTAMP_FORMAT)}-{id}"
+
+
+def decode_cursor(cursor):
+    """Turn a cursor from the querystring back into (timestamp, id).
+
+    Returns None when there is no cursor (first page); aborts with a 400 if
+    the cursor is malformed.
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        timestamp, id = cursor.split('-')
+        return datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT), int(id)
+    except ValueError:
+        abort(400)
+
+
+def keyset_page(query, columns, before, per_page, key):
+    """Fetch one page of `query`, newest first.
+
+    - columns: the (timestamp, id) columns to order and page by
+    - before: decoded cursor of the previous page, or None for the first page
+    - key: maps a returned row to its (timestamp, id) values
+
+    Returns (rows, cursor for the next page or None if this is the last).
+    """
+
+    if before is not None:
+        query = query.filter(tuple_(*columns) < tuple_(*before))
+
+    rows = (query
+            .order_by(*[column.desc() for column in columns])
+            .limit(per_page + 1)
+            .all())
+
+    if len(rows) > per_page:
+        return rows[:per_page], encode_cursor(*key(rows[per_page - 1]))
+
+    return rows, None
@@ -0,0 +1,142 @@
+"""Password hashing for Warbler, run off the request thread.
+
+bcrypt is deliberately expensive CPU work. Run inline, a burst of logins pins
+every web worker; here hashes are computed in a small pool of processes, with
+a bound on how many may be waiting, so request threads only block on a
+future and the CPU spent on hashing is capped by the pool size.
+
+Each web worker process has its own pool, so the cap across a server is
+the number of workers times BCRYPT_POOL_WORKERS.
+
+The work factor comes from BCRYPT_LOG_ROUNDS. Hashes made with a different
+factor are reported by needs_rehash(), so User.authenticate() can upgrade
+them on the next successful login.
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+
+from flask_bcrypt import Bcrypt
+
+bcrypt = Bcrypt()
+
+
+def _hash(password, rounds):
+    return bcrypt.generate_password_hash(password, rounds).decode('UTF-8')
+
+
+def _check(pw_hash, password):
+    return bcrypt.check_password_hash(pw_hash, password)
+
+
+def hash_rounds(pw_hash):
+    """Work factor a bcrypt hash was made with: '$2b$12$...' -> 12."""
+
+    try:
+        return int(pw_hash.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    """bcrypt hashing and checking on a bounded process pool.
+
+    With `workers` set to 0 the work runs inline on the calling thread.
+    """
+
+    def __init__(self, rounds=12, workers=0, max_pending=64):
+        self.rounds = rounds
+        self.workers = workers
+        self.max_pending = max_pending
+
+        self._pool = None
+        self._pool_lock = Lock()
+        self._slots = BoundedSemaphore(max_pending)
+
+        self._stats_lock = Lock()
+        self.pending = 0
+        self.peak_pending = 0
+        self.completed = 0
+        self.seconds = 0.0
+
+    def init_app(self, app):
+        """Configure from BCRYPT_LOG_ROUNDS, BCRYPT_POOL_WORKERS and
+        BCRYPT_POOL_MAX_PENDING."""
+
+        self.rounds = app.config['BCRYPT_LOG_ROUNDS']
+        self.workers = app.config['BCRYPT_POOL_WORKERS']
+        self.max_pending = app.config['BCRYPT_POOL_MAX_PENDING']
+        self._slots = BoundedSemaphore(self.max_pending)
+
+    def hash(self, password):
+        """Hash `password` with the configured work factor."""
+
+        if not password:
+            raise ValueError('Password must be non-empty.')
+
+        return self._run(_hash, password, self.rounds)
+
+    def check(self, pw_hash, password):
+        """Does `password` match `pw_hash`?
+
+        Raises ValueError if `pw_hash` isn't a bcrypt hash.
+        """
+
+        return self._run(_check, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """Was `pw_hash` made with a different work factor than configured?"""
+
+        return hash_rounds(pw_hash) != self.rounds
+
+    def stats(self):
+        """Queue depth and timing counters, for monitoring."""
+
+        with self._stats_lock:
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'pending': self.pending,
+                'peak_pending': self.peak_pending,
+                'completed': self.completed,
+                'seconds': self.seconds,
+            }
+
+    def _run(self, func, *args):
+        # blocks once max_pending hashes are already queued or running
+        with self._slots:
+            with self._stats_lock:
+                self.pending += 1
+                self.peak_pending = max(self.peak_pending, self.pending)
+
+            start = perf_counter()
+            try:
+                if not self.workers:
+                    return func(*args)
+                return self._get_pool().submit(func, *args).result()
+            finally:
+                self._record(perf_counter() - start)
+
+    def _record(self, seconds):
+        with self._stats_lock:
+            self.pending -= 1
+            self.completed += 1
+            self.seconds += seconds
+
+    def _get_pool(self):
+        # Created on first use, so each forked web worker gets its own pool.
+        # Pool processes are spawned rather than forked, so they don't
+        # inherit the web worker's threads, locks or database connections.
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context('spawn'))
+
+        return self._pool
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,105 @@
+"""Record the SQL statements Warbler runs.
+
+    with QueryLog(db.engine) as log:
+        client.get('/')
+    print(log.count, log.seconds)
+
+Used by benchmarks.py; cheap enough to wrap individual requests. Tests use
+max_queries() to put a budget on a request, which catches lazy loads (N+1
+queries) creeping into templates:
+
+    with max_queries(3):
+        client.get('/')
+"""
+
+import re
+from collections import Counter
+from contextlib import ContextDecorator
+from threading import get_ident
+from time import perf_counter
+
+from sqlalchemy import event
+
+from models import db
+
+# literals and bind parameters, which vary between otherwise identical
+# statements
+LITERALS = re.compile(r"%\(\w+\)s|\?|'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+class QueryLog:
+    """Statements executed on `engine` by this thread while the log is
+    active, as (sql, seconds, rows) tuples in `statements`."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+        self._thread = None
+        self._starts = []
+
+    def __enter__(self):
+        self._thread = get_ident()
+        event.listen(self.engine, 'before_cursor_execute', self._before)
+        event.listen(self.engine, 'after_cursor_execute', self._after)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._before)
+        event.remove(self.engine, 'after_cursor_execute', self._after)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    @property
+    def seconds(self):
+        return sum(seconds for _, seconds, _ in self.statements)
+
+    @property
+    def rows(self):
+        return sum(max(rows, 0) for _, _, rows in self.statements)
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        if get_ident() == self._thread:
+            self._starts.append(perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        if get_ident() == self._thread:
+            start = self._starts.pop()
+            self.statements.append(
+                (statement, perf_counter() - start, cursor.rowcount))
+
+
+def statement_shape(statement):
+    """`statement` with its literals and parameters replaced by '?' and
+    whitespace collapsed, so repeats of one query compare equal."""
+
+    return " ".join(LITERALS.sub("?", statement).split())
+
+
+class max_queries(ContextDecorator):
+    """Fail (AssertionError) if the wrapped code runs more than `limit`
+    SQL statements; the message lists them grouped by shape, most frequent
+    first. Works as a context manager or a decorator."""
+
+    def __init__(self, limit, engine=None):
+        self.limit = limit
+        self.engine = engine
+
+    def __enter__(self):
+        self.log = QueryLog(self.engine or db.engine).__enter__()
+        return self.log
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.log.__exit__(exc_type, exc_value, traceback)
+
+        if exc_type is None and self.log.count > self.limit:
+            shapes = Counter(statement_shape(statement)
+                             for statement, _, _ in self.log.statements)
+            raise AssertionError(
+                f"{self.log.count} SQL statements, over the budget of "
+                f"{self.limit}:\n" +
+                "\n".join(f"  {count} x {shape}"
+                          for shape, count in shapes.most_common()))
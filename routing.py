@@ -0,0 +1,171 @@
+"""Connection pooling and read-replica routing for Warbler's database.
+
+RoutingSQLAlchemy is Flask-SQLAlchemy configured from the DATABASE_POOL_*
+settings, with two additions:
+
+- Read-only routes (DATABASE_REPLICA_ENDPOINTS) run their queries on one of
+  the DATABASE_REPLICA_URLS, picked per request. Writes, flushes and
+  everything outside those routes use the primary (SQLALCHEMY_DATABASE_URI).
+
+- A client that just wrote something reads from the primary for the next
+  DATABASE_PRIMARY_AFTER_WRITE seconds, so replication lag can't hide their
+  own changes from them. This is remembered in their session cookie, so it
+  holds whichever worker serves them next.
+
+With no replica URLs configured, everything uses the primary as before.
+
+Every pool records how long checkouts waited for a connection (pool_stats),
+which is the first sign of too small a pool.
+"""
+
+import random
+from threading import Lock
+from time import perf_counter, time
+
+from flask import g, has_app_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+
+# session key: until when (time()) this client reads from the primary
+PRIMARY_UNTIL = '_db_primary_until'
+
+
+class PoolStats:
+    """Connection checkouts across all pools, and how long they waited."""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._lock = Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'wait_seconds': self.wait_seconds,
+                'max_wait_seconds': self.max_wait_seconds,
+            }
+
+
+pool_stats = PoolStats()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool recording checkout wait times in pool_stats."""
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_stats.observe(perf_counter() - start)
+
+
+class RoutingSession(SignallingSession):
+    """Session sending the reads of replica-routed requests to the
+    request's replica."""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        replica = has_app_context() and g.get('_db_replica')
+
+        if (replica and not self._flushing
+                and not isinstance(clause, UpdateBase)):
+            return replica
+
+        return super().get_bind(mapper, clause, **kwargs)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with tuned pools and read replicas."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.replicas = []
+        self.replica_endpoints = set()
+        self.primary_after_write = 0
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self._stats_lock = Lock()
+
+    def init_app(self, app):
+        """Also create the replica engines, and route each request."""
+
+        super().init_app(app)
+
+        self.replicas = [
+            create_engine(url, **pool_options(app, make_url(url)))
+            for url in app.config['DATABASE_REPLICA_URLS']
+        ]
+        self.replica_endpoints = set(app.config['DATABASE_REPLICA_ENDPOINTS'])
+        self.primary_after_write = app.config['DATABASE_PRIMARY_AFTER_WRITE']
+
+        app.before_request(self._route)
+        app.after_request(self._note_write)
+
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        result = super().apply_driver_hacks(app, sa_url, options)
+        options.update(pool_options(app, sa_url))
+        return result
+
+    def stats(self):
+        """How many requests were routed to a replica, and how many
+        replica-routable ones read from the primary after a write."""
+
+        with self._stats_lock:
+            return {
+                'replica_reads': self.replica_reads,
+                'primary_reads': self.primary_reads,
+            }
+
+    def _route(self):
+        if (not self.replicas or request.method != 'GET'
+                or request.endpoint not in self.replica_endpoints):
+            return
+
+        if session.get(PRIMARY_UNTIL, 0) > time():
+            self._count('primary_reads')
+            return
+
+        self._count('replica_reads')
+        g._db_replica = random.choice(self.replicas)
+
+    def _note_write(self, response):
+        if self.replicas and request.method not in ('GET', 'HEAD',
+                                                    'OPTIONS'):
+            session[PRIMARY_UNTIL] = time() + self.primary_after_write
+
+        return response
+
+    def _count(self, counter):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+def pool_options(app, sa_url):
+    """create_engine() pool options from the DATABASE_POOL_* settings."""
+
+    if not sa_url.drivername.startswith('postgresql'):
+        return {}
+
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': app.config['DATABASE_POOL_SIZE'],
+        'max_overflow': app.config['DATABASE_MAX_OVERFLOW'],
+        'pool_timeout': app.config['DATABASE_POOL_TIMEOUT'],
+        'pool_recycle': app.config['DATABASE_POOL_RECYCLE'],
+        'pool_pre_ping': app.config['DATABASE_POOL_PRE_PING'],
+    }
@@ -0,0 +1,125 @@
+"""In-memory username prefix index for Warbler's autocomplete.
+
+Substring search on /users goes to the database (backed by a pg_trgm index,
+see USERNAME_TRGM_INDEX in models.py). Autocomplete only needs prefixes, so
+each worker keeps every username in a sorted list and answers lookups with a
+binary search, without touching the database.
+"""
+
+from bisect import bisect_left, insort
+from threading import Lock, Thread
+from time import monotonic
+
+from flask import current_app
+
+from models import db, User
+
+
+class UsernameIndex:
+    """Sorted (lowercased username, username, id) entries.
+
+    The index loads lazily on first use. Once it is older than `ttl`
+    seconds a background thread rebuilds it, while lookups keep using the
+    old one, which bounds how long changes made by other workers take to
+    show up. Changes made in this worker are applied straight away via
+    add() and remove(). Every read and write of the entries holds the lock;
+    a rebuild is swapped in whole.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._entries = []
+        self._loaded_at = None
+        self._lock = Lock()
+        self._refreshing = None
+
+    def reset(self):
+        """Forget everything; the next lookup reloads from the database."""
+
+        with self._lock:
+            self._entries = []
+            self._loaded_at = None
+
+    def load(self):
+        """(Re)build the index from the users table."""
+
+        rows = db.session.query(User.username, User.id).all()
+        entries = sorted((username.lower(), username, id)
+                         for username, id in rows)
+
+        with self._lock:
+            self._entries = entries
+            self._loaded_at = monotonic()
+
+    def wait(self):
+        """Wait for a background rebuild to finish."""
+
+        thread = self._refreshing
+        if thread is not None:
+            thread.join()
+
+    def add(self, username, id):
+        """Index a new or renamed user."""
+
+        with self._lock:
+            insort(self._entries, (username.lower(), username, id))
+
+    def remove(self, username, id):
+        """Drop a deleted or renamed user."""
+
+        entry = (username.lower(), username, id)
+
+        with self._lock:
+            i = bisect_left(self._entries, entry)
+            if i < len(self._entries) and self._entries[i] == entry:
+                del self._entries[i]
+
+    def search(self, prefix, limit=10):
+        """Users whose username starts with `prefix` (case-insensitive).
+
+        Returns up to `limit` (username, id) pairs in alphabetical order, so
+        an exact match always comes first.
+        """
+
+        if self._loaded_at is None:
+            self.load()
+        elif monotonic() - self._loaded_at > self.ttl:
+            self._refresh()
+
+        prefix = prefix.lower()
+        matches = []
+
+        with self._lock:
+            entries = self._entries
+            i = bisect_left(entries, (prefix,))
+            while (i < len(entries) and len(matches) < limit
+                   and entries[i][0].startswith(prefix)):
+                matches.append(entries[i][1:])
+                i += 1
+
+        return matches
+
+    def _refresh(self):
+        """Rebuild the index in the background, unless that's under way."""
+
+        with self._lock:
+            if self._refreshing is not None:
+                return
+
+            thread = Thread(target=self._load_in_background,
+                            args=(current_app._get_current_object(),),
+                            daemon=True)
+            self._refreshing = thread
+
+        thread.start()
+
+    def _load_in_background(self, app):
+        try:
+            with app.app_context():
+                self.load()
+        finally:
+            with self._lock:
+                self._refreshing = None
+
+
+username_index = UsernameIndex()
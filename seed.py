@@ -1,20 +1,26 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+    python seed.py                          # reset, load generator/*.csv
+    python seed.py --data-dir big-dataset   # load another generated dataset
+    python seed.py --resume                 # continue an interrupted load
 
+See loader.py for how the load works.
+"""
 
-db.drop_all()
-db.create_all()
+from argparse import ArgumentParser
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+from app import app
+from loader import load
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+parser = ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--data-dir', default='generator',
+                    help="directory holding users.csv, messages.csv, "
+                         "follows.csv and (optionally) likes.csv")
+parser.add_argument('--chunk-size', type=int, default=10000,
+                    help="rows per COPY/INSERT batch and per commit")
+parser.add_argument('--resume', action='store_true',
+                    help="keep what's loaded and continue where it stopped")
+args = parser.parse_args()
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
-
-db.session.commit()
+with app.app_context():
+    load(args.data_dir, args.chunk_size, args.resume)
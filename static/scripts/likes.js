@@ -0,0 +1,31 @@
+// Like buttons: toggle the like with fetch() and update the button in
+// place, instead of posting the form and reloading the timeline. Without
+// JavaScript (or if the request fails) the form posts as usual.
+
+document.addEventListener('submit', async function (evt) {
+  const form = evt.target;
+  if (!form.classList.contains('like-form')) return;
+
+  evt.preventDefault();
+  const button = form.querySelector('button');
+  button.disabled = true;
+
+  try {
+    const resp = await fetch(form.action, {
+      method: 'POST',
+      headers: {Accept: 'application/json'},
+      credentials: 'same-origin',
+    });
+    if (!resp.ok) throw new Error(resp.statusText);
+
+    const {liked, likes} = await resp.json();
+    button.classList.toggle('btn-primary', liked);
+    button.classList.toggle('btn-secondary', !liked);
+    button.setAttribute('aria-pressed', liked);
+    button.title = `${likes} ${likes === 1 ? 'like' : 'likes'}`;
+  } catch (err) {
+    form.submit();
+  } finally {
+    button.disabled = false;
+  }
+});
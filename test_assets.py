@@ -0,0 +1,99 @@
+import gzip
+import json
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from assets import assets, build, VENDOR
+
+db.create_all()
+
+
+class AssetsTestCase(TestCase):
+    """Test the static asset build and how built assets are served"""
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.out = os.path.join(self.tmp.name, 'dist')
+        self.manifest = build(app.static_folder, self.out, log=lambda *a: None)
+        assets.load(self.out)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        assets.load(app.config['ASSETS_DIR'])
+        self.tmp.cleanup()
+
+    def test_build(self):
+        """Tests files get content hashes and stylesheets link built files"""
+
+        files = self.manifest['files']
+        css = files['stylesheets/style.css']
+        self.assertRegex(css, r'^stylesheets/style\.[0-9a-f]{12}\.css$')
+        self.assertIn('stylesheets/style.css', files)
+        self.assertIn('gzip', self.manifest['compressed'][css])
+        self.assertNotIn(files['images/warbler-hero.jpg'],
+                         self.manifest['compressed'])
+
+        with open(os.path.join(self.out, css)) as built:
+            content = built.read()
+        self.assertIn(f"/static/dist/{files['images/nav-bg.png']}", content)
+        self.assertNotIn('/static/images/', content)
+
+        with open(os.path.join(self.out, 'manifest.json')) as manifest:
+            self.assertEqual(json.load(manifest), self.manifest)
+
+        # same content, same names
+        again = build(app.static_folder, self.out, log=lambda *a: None)
+        self.assertEqual(again, self.manifest)
+
+    def test_static_url(self):
+        """Tests templates link built files, and fall back without a build"""
+
+        files = self.manifest['files']
+
+        with app.test_request_context():
+            self.assertEqual(assets.static_url('stylesheets/style.css'),
+                             f"/static/dist/{files['stylesheets/style.css']}")
+            self.assertEqual(
+                assets.static_url('/static/images/default-pic.png'),
+                f"/static/dist/{files['images/default-pic.png']}")
+            self.assertEqual(assets.static_url('http://example.com/a.png'),
+                             'http://example.com/a.png')
+            self.assertEqual(assets.static_url('vendor/jquery.js'),
+                             VENDOR['vendor/jquery.js'])
+            self.assertIsNone(assets.static_url(None))
+
+            assets.load(os.path.join(self.tmp.name, 'missing'))
+            self.assertEqual(assets.static_url('stylesheets/style.css'),
+                             '/static/stylesheets/style.css')
+
+    def test_send(self):
+        """Tests built files are cached for good and sent compressed"""
+
+        css = self.manifest['files']['stylesheets/style.css']
+
+        resp = self.client.get(f'/static/dist/{css}')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+        self.assertNotIn('Content-Encoding', resp.headers)
+        plain = resp.get_data()
+
+        resp = self.client.get(f'/static/dist/{css}',
+                               headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertTrue(resp.content_type.startswith('text/css'))
+        self.assertEqual(gzip.decompress(resp.get_data()), plain)
+
+        self.assertEqual(
+            self.client.get('/static/dist/manifest.json').status_code, 404)
+
+        resp = self.client.get('/')
+        self.assertIn(f'/static/dist/{css}', resp.get_data(as_text=True))
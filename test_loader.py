@@ -0,0 +1,116 @@
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from loader import load
+
+db.create_all()
+
+CSVS = {
+    'users.csv': [
+        "email,username,image_url,password,bio,header_image_url,location",
+        "a@test.com,alice,,$2b$04$hash,Hi there,,Paris",
+        "b@test.com,bob,,$2b$04$hash,,,",
+        "c@test.com,carol,,$2b$04$hash,\"Comma, quote \"\" and all\",,",
+    ],
+    'messages.csv': [
+        "text,timestamp,user_id",
+        "one,2017-01-01 10:00:00.000000,1",
+        "two,2017-01-02 10:00:00.000000,1",
+        "three,2017-01-03 10:00:00.000000,2",
+        "four,2017-01-04 10:00:00.000000,3",
+        "five,2017-01-05 10:00:00.000000,3",
+    ],
+    'follows.csv': [
+        "user_being_followed_id,user_following_id",
+        "1,2",
+        "3,2",
+        "2,1",
+    ],
+    'likes.csv': [
+        "user_id,message_id",
+        "2,1",
+        "2,4",
+    ],
+}
+
+
+class Interrupted(Exception):
+    pass
+
+
+class LoaderTestCase(TestCase):
+    """Test the CSV bulk loader"""
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+
+        for filename, lines in CSVS.items():
+            with open(os.path.join(self.tmp.name, filename), 'w') as f:
+                f.write("\n".join(lines) + "\n")
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+        self.tmp.cleanup()
+
+    def assert_loaded(self):
+        self.assertEqual(
+            [(u.id, u.username) for u in User.query.order_by(User.id)],
+            [(1, 'alice'), (2, 'bob'), (3, 'carol')])
+        self.assertEqual(Message.query.count(), 5)
+        self.assertEqual(Follows.query.count(), 3)
+        self.assertEqual(Likes.query.count(), 2)
+
+        carol = User.query.get(3)
+        self.assertEqual(carol.bio, 'Comma, quote " and all')
+        self.assertIsNone(User.query.get(2).bio)
+
+        bob = User.query.get(2)
+        self.assertEqual((bob.messages_count, bob.following_count,
+                          bob.followers_count, bob.likes_count),
+                         (1, 2, 1, 2))
+
+        # bob's timeline: his own message plus alice's and carol's
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=2).count(), 5)
+
+    def test_load(self):
+        """Loads every CSV, then counters, timelines and sequences"""
+
+        load(self.tmp.name, chunk_size=2, log=lambda line: None)
+        self.assert_loaded()
+
+        # sequences continue after the loaded ids, and triggers are back on
+        dave = User.signup('dave', 'd@test.com', 'password', None)
+        db.session.commit()
+        self.assertEqual(dave.id, 4)
+
+        db.session.add(Message(text='hi', user_id=dave.id))
+        db.session.commit()
+        self.assertEqual(User.query.get(4).messages_count, 1)
+
+    def test_resume(self):
+        """An interrupted load resumes after its last committed chunk"""
+
+        def interrupt(line):
+            if line.startswith('messages:'):
+                raise Interrupted(line)
+
+        with self.assertRaises(Interrupted):
+            load(self.tmp.name, chunk_size=2, log=interrupt)
+
+        db.session.rollback()
+        self.assertEqual(Message.query.count(), 2)
+
+        load(self.tmp.name, chunk_size=2, resume=True, log=lambda line: None)
+        self.assert_loaded()
+        self.assertEqual(
+            [m.text for m in Message.query.order_by(Message.id)],
+            ['one', 'two', 'three', 'four', 'five'])
@@ -1,7 +1,10 @@
 import os
+from datetime import datetime, timedelta
+from time import sleep
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, TimelineEntry
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
@@ -124,11 +127,148 @@ class MessageModelTestCase(TestCase):
         self.assertNotIn(self.new_msg, test_user2.likes)
 
 
+    def test_timeline_fan_out(self):
+        """Tests messages are fanned out to the author and their followers"""
 
+        test_user2 = User(
+            email="tester@tester.com",
+            username="testuser2",
+            password="hashed"
+        )
+        db.session.add(test_user2)
+        test_user2.following.append(self.test_user1)
+        db.session.commit()
+
+        msg = Message(text='Fan me out', user_id=self.test_user1.id)
+        db.session.add(msg)
+        db.session.flush()
+        TimelineEntry.fan_out(msg)
+        db.session.commit()
+
+        readers = {entry.user_id for entry
+                   in TimelineEntry.query.filter_by(message_id=msg.id)}
+        self.assertEqual(readers, {self.test_user1.id, test_user2.id})
+
+
+    def test_timeline_rebuild(self):
+        """Tests timelines can be rebuilt from messages and follows"""
+
+        test_user2 = User(
+            email="tester@tester.com",
+            username="testuser2",
+            password="hashed"
+        )
+        db.session.add(test_user2)
+        test_user2.following.append(self.test_user1)
+        db.session.commit()
+
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        timeline = {entry.message_id for entry
+                    in TimelineEntry.query.filter_by(user_id=test_user2.id)}
+        self.assertEqual(timeline, {self.new_msg.id, self.another_msg.id})
+
+
+    @patch.object(TimelineEntry, 'MAX_LENGTH', 2)
+    def test_message_timestamp(self):
+        """Tests messages are stamped when created, so new posts are the
+        newest in timelines and survive pruning"""
 
+        self.test_user1.messages[0].timestamp = datetime(2020, 1, 1)
+        db.session.flush()
+        TimelineEntry.fan_out(self.test_user1.messages[0])
+
+        before = datetime.utcnow()
+        sleep(0.01)
+
+        posted = []
+        for i in range(2):
+            msg = Message(text=f'Now {i}', user_id=self.test_user1.id)
+            db.session.add(msg)
+            db.session.flush()
+            TimelineEntry.fan_out(msg)
+            posted.append(msg)
+            sleep(0.01)
+        db.session.commit()
+        TimelineEntry.prune_all()
 
+        self.assertGreater(posted[0].timestamp, before)
+        self.assertGreater(posted[1].timestamp, posted[0].timestamp)
 
+        timeline = [entry.message_id for entry
+                    in TimelineEntry.query
+                    .filter_by(user_id=self.test_user1.id)
+                    .order_by(TimelineEntry.timestamp)]
+        self.assertEqual(timeline, [msg.id for msg in posted])
 
 
+    @patch.object(TimelineEntry, 'BACKFILL_PER_AUTHOR', 2)
+    @patch.object(TimelineEntry, 'MAX_LENGTH', 3)
+    def test_timeline_limits(self):
+        """Tests following backfills only an author's newest messages, and
+        timelines keep only their newest entries"""
 
+        test_user2 = User(
+            email="tester@tester.com",
+            username="testuser2",
+            password="hashed"
+        )
+        db.session.add(test_user2)
+        db.session.commit()
+
+        start = datetime(2020, 1, 1)
+        db.session.add_all(Message(text=f'Old {i}', user_id=self.test_user1.id,
+                                   timestamp=start + timedelta(minutes=i))
+                           for i in range(3))
+        db.session.commit()
+
+        def timeline():
+            return [entry.message_id for entry
+                    in TimelineEntry.query
+                    .filter_by(user_id=test_user2.id)
+                    .order_by(TimelineEntry.timestamp)]
+
+        Follows.follow(test_user2.id, [self.test_user1.id])
+        TimelineEntry.add_authors(test_user2.id, [self.test_user1.id])
+        db.session.commit()
+        self.assertEqual(set(timeline()),
+                         {self.new_msg.id, self.another_msg.id})
+
+        newer = []
+        for i in range(2):
+            msg = Message(text=f'New {i}', user_id=test_user2.id,
+                          timestamp=datetime.utcnow() + timedelta(hours=i))
+            db.session.add(msg)
+            db.session.flush()
+            TimelineEntry.fan_out(msg)
+            newer.append(msg.id)
+        db.session.commit()
+
+        # posting doesn't prune, the periodic job does
+        self.assertEqual(len(timeline()), 4)
+        self.assertEqual(TimelineEntry.prune_all(batch_size=1), 1)
+        self.assertEqual(len(timeline()), 3)
+        self.assertEqual(timeline()[1:], newer)
+
+        TimelineEntry.rebuild()
+        db.session.commit()
+        self.assertEqual(len(timeline()), 3)
+        self.assertEqual(timeline()[1:], newer)
+
+
+    def test_liked_ids_among(self):
+        """Tests batch like-state lookup returns only liked message ids"""
+
+        test_user2 = User(
+            email="tester@tester.com",
+            username="testuser2",
+            password="hashed"
+        )
+        db.session.add(test_user2)
+        test_user2.likes.append(self.new_msg)
+        db.session.commit()
 
+        ids = [self.new_msg.id, self.another_msg.id]
+        self.assertEqual(test_user2.liked_ids_among(ids), {self.new_msg.id})
+        self.assertEqual(self.test_user1.liked_ids_among(ids), set())
@@ -6,9 +6,10 @@
 
 
 import os
+import re
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, Likes, TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -20,7 +21,8 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, message_fragments
+from querylog import max_queries
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -74,7 +76,8 @@ class MessageViewTestCase(TestCase):
             # Now, that session setting is saved, so we can have
             # the rest of ours test
 
-            resp = c.post("/messages/new", data={"text": "Hello"})
+            with max_queries(6):
+                resp = c.post("/messages/new", data={"text": "Hello"})
 
             # Make sure it redirects
             self.assertEqual(resp.status_code, 302)
@@ -135,7 +138,8 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
 
             #tests that liked message displays on user likes page
-            get_resp = self.client.get(f"/users/{self.testuser2.id}/likes")
+            with max_queries(4):
+                get_resp = self.client.get(f"/users/{self.testuser2.id}/likes")
             html = get_resp.get_data(as_text=True)
             self.assertIn("Test Message", html)
 
@@ -147,6 +151,33 @@ class MessageViewTestCase(TestCase):
             html = get_resp.get_data(as_text=True)
             self.assertNotIn("Test Message", html)
 
+    def test_like_message_json(self):
+        """Tests scripts can toggle a like in one statement and get its new
+        state back"""
+
+        json_headers = {'Accept': 'application/json'}
+        url = f"/users/add_like/{self.messageid}"
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser2.id
+
+            # loading the user, then the toggle
+            with max_queries(2):
+                resp = c.post(url, headers=json_headers)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.get_json(), {'liked': True, 'likes': 1})
+
+            resp = c.post(url, headers=json_headers)
+            self.assertEqual(resp.get_json(), {'liked': False, 'likes': 0})
+
+            resp = c.post("/users/add_like/999999", headers=json_headers)
+            self.assertEqual(resp.status_code, 404)
+
+        resp = app.test_client().post(url, headers=json_headers)
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(Likes.query.count(), 0)
+
     def test_like_message_loggedout(self):
         """Tests that message cannot be liked when logged out (no g.user)"""
         
@@ -154,4 +185,114 @@ class MessageViewTestCase(TestCase):
         html = resp.get_data(as_text=True)
 
         self.assertEqual(resp.status_code, 200)
-        self.assertIn("Access unauthorized.", html)
\ No newline at end of file
+        self.assertIn("Access unauthorized.", html)
+
+
+    def test_homepage_timeline(self):
+        """Tests new messages reach followers' home timelines and leave
+        them again on unfollow"""
+
+        self.testuser2.following.append(self.testuser)
+        db.session.commit()
+
+        author_id = self.testuser.id
+        reader_id = self.testuser2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = author_id
+
+            c.post("/messages/new", data={"text": "Fanned out"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = reader_id
+
+            resp = c.get("/")
+            self.assertIn("Fanned out", resp.get_data(as_text=True))
+
+            c.post(f"/users/stop-following/{author_id}")
+            resp = c.get("/")
+            self.assertNotIn("Fanned out", resp.get_data(as_text=True))
+
+
+    def test_homepage_pagination(self):
+        """Tests the home timeline is served in pages linked by a cursor"""
+
+        for i in range(30):
+            msg = Message(text=f"Paged message {i}", user_id=self.testuser.id)
+            db.session.add(msg)
+            db.session.flush()
+            TimelineEntry.fan_out(msg)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertEqual(html.count('class="list-group-item"'), 25)
+            self.assertIn("Paged message 29", html)
+            self.assertNotIn("Paged message 4<", html)
+
+            next_url = re.search(r'href="([^"]+)"[^>]*id="load-more"', html)
+            html = c.get(next_url.group(1).replace('&amp;', '&')).get_data(as_text=True)
+            self.assertEqual(html.count('class="list-group-item"'), 5)
+            self.assertIn("Paged message 0", html)
+            self.assertNotIn('id="load-more"', html)
+
+            resp = c.get("/?before=not-a-cursor")
+            self.assertEqual(resp.status_code, 400)
+
+
+    def test_message_fragments(self):
+        """Tests message list items are rendered once, with the like button
+        still per viewer, and re-rendered after profile edits"""
+
+        message_fragments.clear()
+        self.testuser2.likes.append(self.testmessage)
+        db.session.commit()
+
+        def stats():
+            return (message_fragments.hits - hits,
+                    message_fragments.misses - misses)
+
+        hits, misses = message_fragments.hits, message_fragments.misses
+
+        liked = re.compile(r'aria-pressed="true"')
+        author_id = self.testuser.id
+        reader_id = self.testuser2.id
+        profile_url = f"/users/{author_id}"
+
+        with self.client as c:
+            html = c.get(profile_url).get_data(as_text=True)
+            self.assertEqual(stats(), (0, 1))
+            self.assertIn("Test Message", html)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = reader_id
+
+            html = c.get(profile_url).get_data(as_text=True)
+            self.assertEqual(stats(), (1, 1))
+            self.assertIn("@testuser<", html)
+            self.assertRegex(html, liked)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = author_id
+
+            c.post("/users/profile", data={
+                "username": "renamed",
+                "email": "test@test.com",
+                "image_url": "",
+                "header_image_url": "",
+                "bio": "",
+                "password": "testuser",
+            })
+            self.assertEqual(len(message_fragments), 0)
+
+            html = c.get(profile_url).get_data(as_text=True)
+            self.assertEqual(stats(), (1, 2))
+            self.assertIn("@renamed<", html)
+            self.assertNotRegex(html, liked)
+
+            c.post(f"/messages/{self.messageid}/delete")
+            self.assertEqual(len(message_fragments), 0)
@@ -0,0 +1,121 @@
+import os
+from unittest import TestCase
+
+from models import db, User, Likes, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import migrations
+from explain import check_query_plans
+
+db.create_all()
+
+# takes a database made from the current models back to the schema the app
+# started with, before any migration
+BASELINE = [
+    "DROP TABLE timeline_entries",
+    "DROP TABLE throttle_buckets",
+    "DROP TABLE page_cache",
+    "DROP TRIGGER follows_counters ON follows",
+    "DROP TRIGGER likes_counters ON likes",
+    "DROP TRIGGER messages_counters ON messages",
+    "ALTER TABLE users DROP COLUMN messages_count, "
+    "DROP COLUMN following_count, DROP COLUMN followers_count, "
+    "DROP COLUMN likes_count",
+    "DROP TRIGGER users_version ON users",
+    "ALTER TABLE users DROP COLUMN version",
+    "DROP SEQUENCE users_version_seq",
+    "DROP INDEX IF EXISTS ix_users_username_trgm",
+    "DROP INDEX ix_messages_user_id_timestamp",
+    "DROP INDEX ix_follows_user_following_id",
+    "DROP INDEX ix_likes_message_id",
+    "ALTER TABLE likes DROP CONSTRAINT uq_likes_user_id_message_id",
+    "ALTER TABLE likes ADD CONSTRAINT likes_message_id_key UNIQUE (message_id)",
+]
+
+
+# enough rows that index scans clearly beat reading whole tables or indexes
+POPULATE = """
+    INSERT INTO users (id, email, username, password)
+    SELECT n, 'user' || n || '@test.com', 'user' || n, 'x'
+      FROM generate_series(3, 102) AS n;
+    INSERT INTO messages (text, timestamp, user_id)
+    SELECT 'warble', now() - n * interval '1 minute', mod(n, 100) + 3
+      FROM generate_series(1, 2000) AS n;
+    INSERT INTO follows (user_being_followed_id, user_following_id)
+    SELECT a, b FROM generate_series(3, 102) AS a, generate_series(3, 102) AS b
+     WHERE a <> b;
+"""
+
+
+class MigrationsTestCase(TestCase):
+    """Test schema migrations and the hot query plans"""
+
+    def setUp(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+        with db.engine.begin() as conn:
+            conn.execute("DROP TABLE IF EXISTS schema_migrations")
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def test_upgrade_from_baseline(self):
+        """Migrating the original schema gives what the models describe"""
+
+        with db.engine.begin() as conn:
+            for statement in BASELINE:
+                conn.execute(statement)
+
+            conn.execute("""
+                INSERT INTO users (id, email, username, password)
+                VALUES (1, 'a@test.com', 'alice', 'x'),
+                       (2, 'b@test.com', 'bob', 'x');
+                INSERT INTO messages (id, text, timestamp, user_id)
+                VALUES (5000, 'hi', now(), 1);
+                INSERT INTO follows VALUES (1, 2);
+                INSERT INTO likes (user_id, message_id) VALUES (2, 5000);
+            """)
+
+        with db.engine.begin() as conn:
+            conn.execute(POPULATE)
+
+        applied = migrations.upgrade(db.engine, log=lambda line: None)
+        self.assertEqual(applied, migrations.available())
+        self.assertEqual(migrations.upgrade(db.engine), [])
+
+        alice, bob = User.query.get(1), User.query.get(2)
+        self.assertEqual((alice.messages_count, alice.followers_count),
+                         (1, 1))
+        self.assertEqual((bob.following_count, bob.likes_count), (1, 1))
+        self.assertEqual(
+            {(e.user_id, e.message_id)
+             for e in TimelineEntry.query.filter_by(message_id=5000)},
+            {(1, 5000), (2, 5000)})
+
+        # more than one user can like a message now
+        db.session.add(Likes(user_id=1, message_id=5000))
+        db.session.commit()
+        self.assertEqual(User.query.get(1).likes_count, 1)
+
+        self.assertEqual(check_query_plans(), {})
+
+    def test_stamp(self):
+        """A database made from the models has nothing to migrate once
+        stamped"""
+
+        migrations.stamp(db.engine)
+        self.assertEqual(migrations.upgrade(db.engine), [])
+
+    def test_query_plans(self):
+        """Hot queries use their indexes"""
+
+        with db.engine.begin() as conn:
+            conn.execute(POPULATE)
+
+        self.assertEqual(check_query_plans(), {})
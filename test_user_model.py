@@ -25,6 +25,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app
+from passwords import password_hasher, hash_rounds
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -157,3 +158,73 @@ class UserModelTestCase(TestCase):
 
         
 
+
+    def test_counters(self):
+        """Tests stored counters follow messages, follows and likes"""
+
+        msg = Message(text='counted')
+        self.test_user2.messages.append(msg)
+        self.test_user1.following.append(self.test_user2)
+        self.test_user1.likes.append(msg)
+        db.session.commit()
+
+        self.assertEqual(self.test_user1.following_count, 1)
+        self.assertEqual(self.test_user1.likes_count, 1)
+        self.assertEqual(self.test_user2.followers_count, 1)
+        self.assertEqual(self.test_user2.messages_count, 1)
+
+        # deleting the message cascades to the like
+        db.session.delete(msg)
+        self.test_user1.following.remove(self.test_user2)
+        db.session.commit()
+
+        self.assertEqual(self.test_user1.following_count, 0)
+        self.assertEqual(self.test_user1.likes_count, 0)
+        self.assertEqual(self.test_user2.followers_count, 0)
+        self.assertEqual(self.test_user2.messages_count, 0)
+
+    def test_reconcile_counters(self):
+        """Tests counters are recomputed from the underlying tables"""
+
+        self.test_user1.following.append(self.test_user2)
+        db.session.commit()
+
+        User.query.update({User.following_count: 42})
+        User.reconcile_counters()
+        db.session.commit()
+
+        self.assertEqual(self.test_user1.following_count, 1)
+        self.assertEqual(self.test_user2.followers_count, 1)
+
+    def test_following_ids_among(self):
+        """Tests batch follow-state lookup returns only followed ids"""
+
+        test_user3 = User(
+            email="third@tester.com",
+            username="testuser3",
+            password="hashed"
+        )
+        self.test_user1.following.append(self.test_user2)
+        db.session.add(test_user3)
+        db.session.commit()
+
+        ids = [self.test_user2.id, test_user3.id]
+        self.assertEqual(self.test_user1.following_ids_among(ids),
+                         {self.test_user2.id})
+        self.assertEqual(self.test_user2.following_ids_among(ids), set())
+        self.assertEqual(self.test_user1.following_ids_among([]), set())
+
+    def test_rehash_on_login(self):
+        """Tests passwords hashed with an outdated work factor are rehashed
+        on successful authentication"""
+
+        old_hash = bcrypt.generate_password_hash('testpw', 4).decode('UTF-8')
+        self.test_user1.password = old_hash
+        db.session.commit()
+
+        self.assertTrue(password_hasher.needs_rehash(old_hash))
+        self.assertIs(User.authenticate('testuser', 'testpw'), self.test_user1)
+        self.assertEqual(hash_rounds(self.test_user1.password),
+                         password_hasher.rounds)
+
+        self.assertFalse(User.authenticate('testuser', 'wrongpassword'))
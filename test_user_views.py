@@ -1,11 +1,20 @@
 import os
+import re
+from threading import Event
 from unittest import TestCase
+from unittest.mock import patch
+from sqlalchemy import create_engine
 from flask import g
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, TimelineEntry
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, MAX_BULK_FOLLOWS, user_cache
+from querylog import QueryLog, max_queries
+from routing import pool_stats
+from search import username_index
+from pagecache import DatabaseBackend as PageDatabaseBackend, page_cache
+from throttle import DatabaseBackend, login_throttle
 
 db.create_all()
 
@@ -173,7 +182,8 @@ class UserViewTestCase(TestCase):
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.testuser.id
 
-            resp = c.get(f'/users/{self.testid2}/followers')
+            with max_queries(6):
+                resp = c.get(f'/users/{self.testid2}/followers')
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -192,7 +202,8 @@ class UserViewTestCase(TestCase):
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.testuser.id
 
-            resp = c.get(f'/users/{self.testid2}/following')
+            with max_queries(6):
+                resp = c.get(f'/users/{self.testid2}/following')
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -218,4 +229,666 @@ class UserViewTestCase(TestCase):
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn('@testuser2', html)
\ No newline at end of file
+            self.assertIn('@testuser2', html)
+
+
+    def test_follow_routes_json(self):
+        """Tests follows are idempotent single statements, keep timelines in
+        step, and can be made in bulk"""
+
+        others = [User.signup(username=f"bulk{i}",
+                              email=f"bulk{i}@test.com",
+                              password="password",
+                              image_url=None)
+                  for i in range(3)]
+        db.session.commit()
+        other_ids = [other.id for other in others]
+        db.session.add(Message(text="Bulk news", user_id=other_ids[0]))
+        db.session.commit()
+
+        json_headers = {'Accept': 'application/json'}
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testid
+
+            for i in range(2):
+                with max_queries(3):
+                    resp = c.post(f'/users/stop-following/{self.testid2}',
+                                  headers=json_headers)
+                self.assertEqual(resp.get_json(), {'following': False})
+
+            for i in range(2):
+                resp = c.post(f'/users/follow/{self.testid2}',
+                              headers=json_headers)
+                self.assertEqual(resp.get_json(), {'following': True})
+
+            self.assertEqual(
+                c.post('/users/follow/0', headers=json_headers).status_code,
+                404)
+            self.assertEqual(
+                c.post(f'/users/follow/{self.testid}',
+                       headers=json_headers).status_code,
+                400)
+
+            # the ids that exist and aren't followed yet are followed
+            with max_queries(4):
+                resp = c.post('/users/follow', headers=json_headers, json={
+                    'ids': other_ids + [self.testid2, self.testid, 0]})
+            self.assertEqual(resp.get_json(), {'followed': other_ids})
+
+            for ids in ['x', '-1', ' 1', '1.5']:
+                resp = c.post('/users/follow', data={'ids': [ids]})
+                self.assertEqual(resp.status_code, 400)
+
+            for body in [{'ids': '123'}, {'ids': [True]}, {'ids': 5},
+                         {'ids': [1.0]}, {'ids': []}, [1],
+                         {'ids': list(range(1, MAX_BULK_FOLLOWS + 2))}]:
+                resp = c.post('/users/follow', json=body)
+                self.assertEqual(resp.status_code, 400)
+
+            resp = c.get('/')
+            self.assertIn("Bulk news", resp.get_data(as_text=True))
+
+        user = User.query.get(self.testid)
+        self.assertEqual(user.following_count, 4)
+        self.assertEqual({followed.id for followed in user.following},
+                         set(other_ids) | {self.testid2})
+
+    def test_follow_buttons(self):
+        """Tests user cards show whether the logged in user follows them"""
+
+        testuser3 = User.signup(username="testuser3",
+                                email="third@tester.com",
+                                password="hashed",
+                                image_url=None)
+        db.session.commit()
+        testid3 = testuser3.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testid
+
+            resp = c.get('/users')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f'/users/stop-following/{self.testid2}', html)
+            self.assertIn(f'/users/follow/{testid3}', html)
+            self.assertNotIn(f'/users/follow/{self.testid}"', html)
+
+
+    def test_profile_pagination(self):
+        """Tests profile messages are served newest first in pages"""
+
+        for i in range(30):
+            db.session.add(Message(text=f"Profile message {i}",
+                                   user_id=self.testid))
+        db.session.commit()
+
+        resp = self.client.get(f'/users/{self.testid}')
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(html.count('class="list-group-item"'), 25)
+        self.assertLess(html.index("Profile message 29"),
+                        html.index("Profile message 28"))
+        self.assertNotIn("Profile message 4<", html)
+
+        next_url = re.search(r'href="([^"]+)"[^>]*id="load-more"', html)
+        resp = self.client.get(next_url.group(1).replace('&amp;', '&'))
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(html.count('class="list-group-item"'), 5)
+        self.assertIn("Profile message 0", html)
+        self.assertNotIn('id="load-more"', html)
+
+
+    def test_search_ranking(self):
+        """Tests search results rank exact, then prefix, then substring
+        matches"""
+
+        User.signup(username="mytestuser",
+                    email="my@tester.com",
+                    password="hashed",
+                    image_url=None)
+        db.session.commit()
+
+        resp = self.client.get('/users', query_string={'q': 'testuser'})
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertLess(html.index('@testuser<'), html.index('@testuser2<'))
+        self.assertLess(html.index('@testuser2<'), html.index('@mytestuser<'))
+
+        resp = self.client.get('/users', query_string={'q': '%'})
+        self.assertIn('Sorry, no users found', resp.get_data(as_text=True))
+
+        # case doesn't matter, as in autocomplete
+        html = self.client.get('/users', query_string={'q': 'TestUser'}
+                               ).get_data(as_text=True)
+        self.assertLess(html.index('@testuser<'), html.index('@testuser2<'))
+        self.assertIn('@mytestuser<', html)
+
+
+    def test_autocomplete(self):
+        """Tests username prefix autocomplete returns JSON matches"""
+
+        username_index.reset()
+
+        resp = self.client.get('/users/autocomplete', query_string={'q': 'TESTUSER'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['users'],
+                         [{'id': self.testid, 'username': 'testuser'},
+                          {'id': self.testid2, 'username': 'testuser2'}])
+
+        resp = self.client.get('/users/autocomplete', query_string={'q': 'nobody'})
+        self.assertEqual(resp.json['users'], [])
+
+        # once stale, lookups use the old index while it's rebuilt
+        db.session.add(User(username="testuser3", email="third@tester.com",
+                            password="hashed"))
+        db.session.commit()
+        username_index._loaded_at -= username_index.ttl + 1
+
+        release = Event()
+        load = username_index.load
+
+        def slow_load():
+            release.wait(5)
+            load()
+
+        with patch.object(username_index, 'load', slow_load):
+            resp = self.client.get('/users/autocomplete',
+                                   query_string={'q': 'testuser3'})
+            self.assertEqual(resp.json['users'], [])
+            release.set()
+            username_index.wait()
+
+        resp = self.client.get('/users/autocomplete', query_string={'q': 'testuser3'})
+        self.assertEqual(resp.json['users'][0]['username'], 'testuser3')
+
+
+    def test_user_directory_pagination(self):
+        """Tests /users lists users in pages continuing after an id"""
+
+        for i in range(30):
+            db.session.add(User(username=f"directory{i}",
+                                email=f"directory{i}@tester.com",
+                                password="hashed"))
+        db.session.commit()
+
+        html = self.client.get('/users').get_data(as_text=True)
+        self.assertEqual(html.count('class="card user-card"'), 24)
+        self.assertIn('@testuser<', html)
+
+        next_url = re.search(r'href="([^"]+)"[^>]*id="load-more"', html)
+        html = self.client.get(next_url.group(1)).get_data(as_text=True)
+        self.assertEqual(html.count('class="card user-card"'), 8)
+        self.assertIn('@directory29<', html)
+        self.assertNotIn('id="load-more"', html)
+
+
+    def test_user_directory_streaming(self):
+        """Tests /users can be streamed to the client"""
+
+        app.config['STREAM_USER_DIRECTORY'] = True
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testid
+
+                resp = c.get('/users')
+                self.assertTrue(resp.is_streamed)
+
+                html = resp.get_data(as_text=True)
+                self.assertIn('@testuser2<', html)
+                self.assertIn(f'/users/stop-following/{self.testid2}', html)
+        finally:
+            app.config['STREAM_USER_DIRECTORY'] = False
+
+
+    def test_session_user_cache(self):
+        """Tests the logged in user is cached between requests and dropped
+        from the cache when their profile changes"""
+
+        user_cache.clear()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testid
+
+            # the navbar is served from the cache, so a page showing nothing
+            # else about the user doesn't load them
+            with max_queries(1):
+                c.get('/messages/new')
+            hits = user_cache.hits
+            with max_queries(0):
+                html = c.get('/messages/new').get_data(as_text=True)
+            self.assertEqual(user_cache.hits, hits + 1)
+            self.assertIn('alt="testuser"', html)
+
+            data = {'username': "renamed",
+                    'email': "test@test.com",
+                    'password': "testuser"}
+            c.post('/users/profile', data=data)
+
+            html = c.get('/').get_data(as_text=True)
+            self.assertIn('@renamed', html)
+
+
+    def test_session_user_cache_deleted(self):
+        """Tests a cached user deleted elsewhere is logged out rather than
+        breaking the page"""
+
+        user_cache.clear()
+        user = User.signup(username="deleteme",
+                           email="deleteme@test.com",
+                           password="password",
+                           image_url=None)
+        db.session.commit()
+        user_id = user.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.get('/messages/new')
+            db.session.delete(User.query.get(user_id))
+            db.session.commit()
+
+            resp = c.get('/')
+            self.assertEqual(resp.status_code, 302)
+            with c.session_transaction() as sess:
+                self.assertNotIn(CURR_USER_KEY, sess)
+            self.assertEqual(c.get('/').status_code, 200)
+
+
+    def test_session_user_cache_counters(self):
+        """Tests pages show the logged in user's live counters, not those
+        cached with them, even when the page loads them too"""
+
+        user_cache.clear()
+        follower = User.signup(username="newfollower",
+                               email="newfollower@test.com",
+                               password="password",
+                               image_url=None)
+        db.session.commit()
+        follower_id = follower.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testid
+
+            c.get('/')
+            follower = User.query.get(follower_id)
+            follower.following.append(User.query.get(self.testid))
+            db.session.commit()
+
+            for url in ['/', f'/users/{self.testid}']:
+                hits = user_cache.hits
+                html = c.get(url).get_data(as_text=True)
+                self.assertEqual(user_cache.hits, hits + 1)
+                self.assertRegex(
+                    html, rf'href="/users/{self.testid}/followers">\s*2<')
+
+
+    def test_missing_images(self):
+        """Tests users loaded without images (NULLs) still render"""
+
+        user = User.query.get(self.testid)
+        user.image_url = None
+        user.header_image_url = None
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testid
+
+            for url in ['/', f'/users/{self.testid}',
+                        f'/users/{self.testid2}/followers']:
+                with self.subTest(url=url):
+                    self.assertEqual(c.get(url).status_code, 200)
+
+
+    def test_login_throttle(self):
+        """Tests repeated login attempts for a username are turned away
+        before their password is checked"""
+
+        login_throttle.backend.clear()
+        shed = login_throttle.stats()['shed_by_username']
+
+        try:
+            data = {'username': 'testuser', 'password': 'wrongpassword'}
+
+            for i in range(login_throttle.username_burst):
+                resp = self.client.post('/login', data=data)
+                self.assertIn("Invalid credentials", resp.get_data(as_text=True))
+
+            resp = self.client.post('/login', data=data)
+            self.assertEqual(resp.status_code, 429)
+            self.assertIn("Too many login attempts", resp.get_data(as_text=True))
+            self.assertEqual(login_throttle.stats()['shed_by_username'], shed + 1)
+
+        finally:
+            login_throttle.backend.clear()
+
+
+    def test_database_throttle_backend(self):
+        """Tests token buckets shared through the database"""
+
+        backend = DatabaseBackend(db)
+        backend.clear()
+
+        self.assertTrue(backend.take('user:someone', 2, 0))
+        self.assertTrue(backend.take('user:someone', 2, 0))
+        self.assertFalse(backend.take('user:someone', 2, 0))
+        self.assertTrue(backend.take('user:someone-else', 2, 0))
+
+        backend.clear()
+
+
+    def test_metrics(self):
+        """Tests per-endpoint request and SQL metrics on /metrics"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testid
+
+            c.get(f'/users/{self.testid2}')
+
+            with patch.dict(app.config, METRICS_ALLOWED_IPS=['127.0.0.1']):
+                resp = c.get('/metrics')
+            text = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('warbler_requests_total{endpoint="users_show",'
+                          'status="200"}', text)
+            self.assertIn('warbler_request_seconds_count{endpoint="users_show"}',
+                          text)
+            self.assertRegex(
+                text,
+                r'warbler_request_queries_bucket\{endpoint="users_show",'
+                r'le="\+Inf"\} [1-9]')
+            self.assertIn('warbler_user_cache_hits_total', text)
+
+            resp = c.get('/metrics', environ_base={'REMOTE_ADDR': '10.1.2.3'})
+            self.assertEqual(resp.status_code, 404)
+
+    def test_metrics_access(self):
+        """Tests /metrics is off unless a token or addresses are configured,
+        and doesn't trust X-Forwarded-For without trusted proxies"""
+
+        remote = {'REMOTE_ADDR': '10.1.2.3'}
+        forwarded = {'X-Forwarded-For': '127.0.0.1'}
+
+        with patch.dict(app.config, METRICS_TOKEN=None,
+                        METRICS_ALLOWED_IPS=[]):
+            self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+        with patch.dict(app.config, METRICS_TOKEN='s3cret',
+                        METRICS_ALLOWED_IPS=[]):
+            for auth, status in [('Bearer s3cret', 200), ('Bearer nope', 404),
+                                 ('', 404)]:
+                resp = self.client.get('/metrics', environ_base=remote,
+                                       headers={'Authorization': auth})
+                self.assertEqual(resp.status_code, status)
+
+        with patch.dict(app.config, METRICS_TOKEN=None,
+                        METRICS_ALLOWED_IPS=['127.0.0.1'],
+                        METRICS_PROXY_COUNT=0):
+            self.assertEqual(self.client.get(
+                '/metrics', environ_base=remote,
+                headers=forwarded).status_code, 404)
+
+            app.config['METRICS_PROXY_COUNT'] = 1
+            self.assertEqual(self.client.get(
+                '/metrics', environ_base=remote,
+                headers=forwarded).status_code, 200)
+
+
+    def test_query_budgets(self):
+        """Tests pages cost a fixed number of queries however many users
+        and messages they show (no lazy loads per row)"""
+
+        users = [User.signup(username=f"budget{i}",
+                             email=f"budget{i}@test.com",
+                             password="password",
+                             image_url=None)
+                 for i in range(6)]
+        users += [self.testuser, self.testuser2]
+        db.session.commit()
+
+        for user in users:
+            user.following = [other for other in users if other is not user]
+            user.messages.extend(Message(text=f"{user.username} says {i}")
+                                 for i in range(3))
+            db.session.flush()
+            user.likes.append(user.messages[0])
+        db.session.commit()
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        message_id = self.testuser2.messages[0].id
+
+        # logged-in user not cached yet, so each budget includes loading them;
+        # conditional pages also include working out their ETag
+        budgets = {
+            '/': 3,
+            '/users': 4,
+            '/users?q=budget': 3,
+            f'/users/{self.testid2}': 6,
+            f'/users/{self.testid2}/following': 6,
+            f'/users/{self.testid2}/followers': 6,
+            f'/users/{self.testid2}/likes': 5,
+            f'/messages/{message_id}': 5,
+        }
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testid
+
+            for url, budget in budgets.items():
+                user_cache.clear()
+
+                with self.subTest(url=url), max_queries(budget):
+                    resp = c.get(url)
+                    resp.get_data()
+                    self.assertEqual(resp.status_code, 200)
+
+    def test_conditional_get(self):
+        """Tests read pages carry ETags and answer 304 until what they show
+        changes"""
+
+        message = Message(text="hello", user_id=self.testid2)
+        db.session.add(message)
+        db.session.commit()
+        message_id = message.id
+
+        urls = [f'/users/{self.testid2}', f'/users/{self.testid2}/following',
+                f'/users/{self.testid2}/followers', f'/messages/{message_id}']
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testid
+
+            etags = {}
+            for url in urls:
+                resp = c.get(url)
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn('private', resp.headers['Cache-Control'])
+                self.assertIn('Cookie', resp.headers['Vary'])
+                etags[url] = resp.headers['ETag']
+
+                with self.subTest(url=url), max_queries(3):
+                    resp = c.get(url, headers={'If-None-Match': etags[url]})
+                    self.assertEqual(resp.status_code, 304)
+                    self.assertEqual(resp.get_data(), b'')
+
+            # the viewer liking a message changes every page (like buttons)
+            c.post(f'/users/add_like/{message_id}')
+
+            for url in urls:
+                resp = c.get(url, headers={'If-None-Match': etags[url]})
+                self.assertEqual(resp.status_code, 200)
+                self.assertNotEqual(resp.headers['ETag'], etags[url])
+
+            # so does someone else following the viewer (their counters),
+            # and the page sent with the new ETag shows it
+            etag = c.get(f'/users/{self.testid}').headers['ETag']
+            follower = User.signup(username="newfollower",
+                                   email="newfollower@test.com",
+                                   password="password",
+                                   image_url=None)
+            follower.following.append(User.query.get(self.testid))
+            db.session.commit()
+
+            resp = c.get(f'/users/{self.testid}',
+                         headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertRegex(resp.get_data(as_text=True),
+                             rf'href="/users/{self.testid}/followers">\s*2<')
+
+            # and a new build of the app
+            etag = resp.headers['ETag']
+            build = app.config['BUILD_VERSION']
+            try:
+                app.config['BUILD_VERSION'] = 'next'
+                resp = c.get(f'/users/{self.testid}',
+                             headers={'If-None-Match': etag})
+            finally:
+                app.config['BUILD_VERSION'] = build
+            self.assertEqual(resp.status_code, 200)
+
+            # pages without their own policy are never stored, and private
+            for url in ['/', f'/users/{self.testid}/likes', '/users']:
+                cache_control = c.get(url).headers['Cache-Control']
+                self.assertIn('private', cache_control)
+                self.assertIn('no-store', cache_control)
+                self.assertNotIn('public', cache_control)
+
+            # flashed messages are shown once, so such pages aren't validated
+            c.get('/logout')
+            resp = c.get(f'/users/{self.testid2}')
+            self.assertNotIn('ETag', resp.headers)
+
+        self.assertIn('no-store',
+                      self.client.get('/login').headers['Cache-Control'])
+        resp = self.client.get(f'/users/{self.testid2}')
+        self.assertIn('public', resp.headers['Cache-Control'])
+        self.assertIn('ETag', resp.headers)
+        self.assertEqual(self.client.get('/users/0').status_code, 404)
+
+    def test_page_cache(self):
+        """Tests anonymous pages are replayed without queries, re-rendered
+        in the background once stale, and never served to a logged-in
+        user"""
+
+        page_cache.backend.clear()
+        page_cache.enabled = True
+        (ttl, stale) = (page_cache.ttl, page_cache.stale)
+        url = f'/users/{self.testid2}'
+
+        try:
+            first = self.client.get(url)
+            self.assertEqual(first.status_code, 200)
+
+            with max_queries(0):
+                resp = self.client.get(url)
+            self.assertEqual(resp.get_data(), first.get_data())
+            self.assertEqual(resp.headers['ETag'], first.headers['ETag'])
+            self.assertIn('Age', resp.headers)
+
+            with max_queries(0):
+                resp = self.client.get(
+                    url, headers={'If-None-Match': first.headers['ETag']})
+            self.assertEqual(resp.status_code, 304)
+
+            # another query string is another page
+            stats = page_cache.stats()
+            self.client.get(url + '?before=x')
+            self.assertEqual(page_cache.stats()['misses'],
+                             stats['misses'] + 1)
+
+            # stale: served as is, and rendered again behind the scenes
+            page_cache.ttl = 0
+            User.query.get(self.testid2).bio = "Fresh bio"
+            db.session.commit()
+
+            resp = self.client.get(url)
+            self.assertNotIn("Fresh bio", resp.get_data(as_text=True))
+            page_cache.wait()
+
+            page_cache.ttl = ttl
+            resp = self.client.get(url)
+            self.assertIn("Fresh bio", resp.get_data(as_text=True))
+            self.assertEqual(page_cache.stats()['stale_hits'],
+                             stats['stale_hits'] + 1)
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testid
+
+                resp = c.get(url)
+                self.assertIn('private', resp.headers['Cache-Control'])
+                self.assertNotIn('Age', resp.headers)
+
+        finally:
+            (page_cache.ttl, page_cache.stale) = (ttl, stale)
+            page_cache.enabled = False
+            page_cache.backend.clear()
+
+
+    def test_database_page_cache_backend(self):
+        """Tests pages shared through the database"""
+
+        backend = PageDatabaseBackend(db)
+        backend.clear()
+
+        page = (1000.5, 200, [('Content-Type', 'text/html')], b'<p>hi</p>')
+        backend.set('/users/1?', page, 60)
+        backend.set('/users/1?', page, 60)
+
+        self.assertEqual(backend.get('/users/1?'), page)
+        self.assertIsNone(backend.get('/users/2?'))
+
+        backend.clear()
+
+
+    def test_read_replica_routing(self):
+        """Tests read-only routes query a replica, except right after the
+        client wrote something"""
+
+        replica = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+        db.replicas = [replica]
+        checkouts = pool_stats.stats()['checkouts']
+        url = f'/users/{self.testid2}'
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testid
+
+                with QueryLog(replica) as replica_log, \
+                        QueryLog(db.engine) as primary_log:
+                    self.assertEqual(c.get(url).status_code, 200)
+                self.assertGreater(replica_log.count, 0)
+                self.assertEqual(primary_log.count, 0)
+
+                # not a read-only route
+                with QueryLog(replica) as replica_log:
+                    c.get(f'{url}/likes')
+                self.assertEqual(replica_log.count, 0)
+
+                c.post(f'/users/stop-following/{self.testid2}')
+
+                with QueryLog(replica) as replica_log:
+                    html = c.get(url).get_data(as_text=True)
+                self.assertEqual(replica_log.count, 0)
+                self.assertIn('>Follow<', html)
+
+            self.assertGreater(pool_stats.stats()['checkouts'], checkouts)
+
+        finally:
+            db.replicas = []
+            replica.dispose()
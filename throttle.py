@@ -0,0 +1,180 @@
+"""Login throttling for Warbler.
+
+Every login attempt for an existing username costs a full bcrypt check, so
+a credential-stuffing burst can eat all of our CPU. Attempts are metered by
+token buckets, one per username and one per client IP, and attempts over the
+limit are turned away before User.authenticate() runs.
+
+Bucket state lives in a backend: MemoryBackend is per process; with several
+workers use DatabaseBackend, which keeps the buckets in Postgres so every
+worker shares them.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from flask import request
+from sqlalchemy import text
+
+
+def client_ip(proxy_count=0):
+    """The requesting client's address.
+
+    Behind `proxy_count` trusted proxies, that is the address the outermost
+    of them put in X-Forwarded-For; anything further left in that header is
+    client-supplied and can't be trusted.
+    """
+
+    route = request.access_route
+    if proxy_count and len(route) >= proxy_count:
+        return route[-proxy_count]
+
+    return request.remote_addr
+
+
+class MemoryBackend:
+    """Token buckets in a per-process LRU dict."""
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    def take(self, key, capacity, rate):
+        """Take a token from bucket `key` if it has one.
+
+        Buckets hold up to `capacity` tokens and refill at `rate` tokens
+        per second. Returns whether a token was taken.
+        """
+
+        now = monotonic()
+
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            # evicting the least recently used buckets only ever refills
+            # them early
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+
+        return allowed
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class DatabaseBackend:
+    """Token buckets in the throttle_buckets table, shared by all workers.
+
+    Each take() is one upsert, run in its own transaction so it counts even
+    when the login request itself rolls back. Postgres only.
+    """
+
+    # tokens in the bucket now: what was left, plus the refill since then
+    REFILLED = ("LEAST(:capacity, throttle_buckets.tokens + :rate * "
+                "EXTRACT(EPOCH FROM now() - throttle_buckets.updated_at))")
+
+    TAKE = text(f"""
+        INSERT INTO throttle_buckets (key, tokens, allowed, updated_at)
+        VALUES (:key, :capacity - 1, true, now())
+        ON CONFLICT (key) DO UPDATE SET
+            tokens = CASE WHEN {REFILLED} >= 1
+                          THEN {REFILLED} - 1
+                          ELSE {REFILLED} END,
+            allowed = {REFILLED} >= 1,
+            updated_at = now()
+        RETURNING allowed
+    """)
+
+    def __init__(self, db):
+        self.db = db
+
+    def take(self, key, capacity, rate):
+        with self.db.engine.begin() as conn:
+            return conn.execute(self.TAKE,
+                                key=key,
+                                capacity=capacity,
+                                rate=rate).scalar()
+
+    def clear(self):
+        with self.db.engine.begin() as conn:
+            conn.execute(text("DELETE FROM throttle_buckets"))
+
+
+class LoginThrottle:
+    """Per-username and per-IP token buckets in front of password checks."""
+
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryBackend()
+
+        self.username_burst = 5
+        self.username_rate = 5 / 60
+        self.ip_burst = 20
+        self.ip_rate = 20 / 60
+        self.proxy_count = 0
+
+        self._stats_lock = Lock()
+        self.allowed = 0
+        self.shed_by_username = 0
+        self.shed_by_ip = 0
+
+    def init_app(self, app, db):
+        """Configure from the LOGIN_THROTTLE_* settings."""
+
+        if app.config['LOGIN_THROTTLE_BACKEND'] == 'database':
+            self.backend = DatabaseBackend(db)
+        else:
+            self.backend = MemoryBackend()
+
+        self.username_burst = app.config['LOGIN_THROTTLE_USERNAME_BURST']
+        self.username_rate = app.config['LOGIN_THROTTLE_USERNAME_PER_MINUTE'] / 60
+        self.ip_burst = app.config['LOGIN_THROTTLE_IP_BURST']
+        self.ip_rate = app.config['LOGIN_THROTTLE_IP_PER_MINUTE'] / 60
+        self.proxy_count = app.config['LOGIN_THROTTLE_PROXY_COUNT']
+
+    def allow(self, username):
+        """May the current request try to log in as `username`?"""
+
+        if not self.backend.take(f"ip:{self.client_ip()}",
+                                 self.ip_burst, self.ip_rate):
+            self._count('shed_by_ip')
+            return False
+
+        if not self.backend.take(f"user:{username.lower()}",
+                                 self.username_burst, self.username_rate):
+            self._count('shed_by_username')
+            return False
+
+        self._count('allowed')
+        return True
+
+    def client_ip(self):
+        """The requesting client's address (see client_ip())."""
+
+        return client_ip(self.proxy_count)
+
+    def stats(self):
+        """How many attempts were let through, and how many bcrypt checks
+        were shed, by which bucket."""
+
+        with self._stats_lock:
+            return {
+                'allowed': self.allowed,
+                'shed_by_username': self.shed_by_username,
+                'shed_by_ip': self.shed_by_ip,
+            }
+
+    def _count(self, counter):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+login_throttle = LoginThrottle()
@@ -0,0 +1,107 @@
+"""Per-process cache of logged-in users for Warbler.
+
+Every request from a logged-in user needs their User row (for g.user). This
+keeps recently seen users in a small LRU so most requests skip that query.
+Entries are detached snapshots of the user's columns; each request gets its
+own copy attached to its session via merge(load=False), which emits no SQL.
+
+Only what the user changes themselves (name, images, profile) comes from
+the snapshot, so the navbar costs nothing; those changes invalidate the
+entry. Their counters and version also move when other users follow or
+like them, so those are expired on the way in and loaded from the live row
+(in one query) by the pages that show them. A copy the request has already
+loaded is never overwritten with cached values.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+
+from models import db, User
+
+# what's loaded from the live row rather than trusted from a snapshot
+LIVE_ATTRIBUTES = ['messages_count', 'following_count', 'followers_count',
+                   'likes_count', 'version']
+
+
+class UserCache:
+    """LRU of user snapshots, keyed by user id.
+
+    Holds at most `maxsize` users, each for at most `ttl` seconds, which
+    bounds how stale a user changed (or deleted) by another worker can be.
+    Changes made in this worker should call invalidate().
+    """
+
+    def __init__(self, maxsize=1024, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def load(self, user_id):
+        """Get user `user_id` for the current request, or None if no such user."""
+
+        snapshot = self._get(user_id)
+
+        if snapshot is not None:
+            current = db.session.identity_map.get(identity_key(User, user_id))
+            if current is not None:
+                return current
+
+            user = db.session.merge(snapshot, load=False)
+            db.session.expire(user, LIVE_ATTRIBUTES)
+            return user
+
+        user = User.query.get(user_id)
+
+        if user is not None:
+            self._put(user)
+
+        return user
+
+    def invalidate(self, user_id):
+        """Drop user `user_id`, e.g. after their row was changed."""
+
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        """Drop every user."""
+
+        with self._lock:
+            self._entries.clear()
+
+    def _get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+
+            if entry is not None and monotonic() > entry[0]:
+                del self._entries[user_id]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(user_id)
+            return entry[1]
+
+    def _put(self, user):
+        # a fresh, session-less copy of the loaded columns, marked as if it
+        # had just been loaded so merge(load=False) will accept it
+        snapshot = User(**{column.key: getattr(user, column.key)
+                           for column in User.__table__.columns})
+        make_transient_to_detached(snapshot)
+
+        with self._lock:
+            self._entries[user.id] = (monotonic() + self.ttl, snapshot)
+            self._entries.move_to_end(user.id)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)